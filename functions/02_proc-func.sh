@@ -42,7 +42,8 @@ noFIX=${17}
 sesAnat=${18}
 dropTR=${19}
 noFC=${20}
-PROC=${21}
+fc_vertex32k=${21}
+PROC=${22}
 export OMP_NUM_THREADS=$threads
 here=$(pwd)
 
@@ -99,6 +100,7 @@ Note "Perform GSR      :" "$performGSR"
 Note "No FIX           :" "$noFIX"
 Note "Longitudinal ses :" "$sesAnat"
 Note "Drop TR          :" "${dropTR}"
+Note "FC vertex 32k    :" "${fc_vertex32k}"
 Note "Surface          :" "${recon}"
 
 #------------------------------------------------------------------------------#
@@ -829,7 +831,8 @@ cleanTS="${func_surf}/${idBIDS}_surf-fsLR-32k_desc-timeseries_clean.shape.gii"
 if [[ ! -f "$cleanTS" ]]; then ((N++))
     Info "Running func post processing"
     labelDirectory="${MICAPIPE}/parcellations/"
-    Do_cmd python "$MICAPIPE"/functions/03_FC.py "$idBIDS" "$proc_func" "$labelDirectory" "$util_parcelations" "$dir_volum" "$performNSR" "$performGSR" "$func_lab" "$noFC" "$GSR"
+    if [[ "$fc_vertex32k" == "TRUE" ]]; then fc_opts=(-fc_vertex32k); else fc_opts=(); fi
+    Do_cmd python "$MICAPIPE"/functions/03_FC.py "$idBIDS" "$proc_func" "$labelDirectory" "$util_parcelations" "$dir_volum" "$performNSR" "$performGSR" "$func_lab" "$noFC" "$GSR" "${fc_opts[@]}"
     if [[ -f "$cleanTS" ]] ; then ((Nsteps++)); fi
 else
     Info "Subject ${id} has post-processed fsLR time-series"; ((Nsteps++)); ((N++))
@@ -62,7 +62,7 @@ if [ "${#parcellations[*]}" -eq "0" ]; then Error "Subject $id doesn't have -pos
 Title "Geodesic distance analysis\n\t\tmicapipe $Version, $PROC"
 micapipe_software
 bids_print.variables-post
-Info "wb_command will use $OMP_NUM_THREADS threads"
+Info "Geodesic distance will use $threads worker processes"
 export OMP_NUM_THREADS="$threads"
 
 #	Timer
@@ -78,12 +78,12 @@ N=0
 lh_fdLR5k="${dir_conte69}/${idBIDS}_hemi-L_space-nativepro_surf-fsLR-5k_label-midthickness.surf.gii"
 rh_fdLR5k="${dir_conte69}/${idBIDS}_hemi-R_space-nativepro_surf-fsLR-5k_label-midthickness.surf.gii"
 outName="${outPath}/${idBIDS}_surf-fsLR-5k_GD"
-if [ -f "${outName}.shape.gii" ]; then
+if [ -f "${outName}_hemi-R.triu.npy" ] || [ -f "${outName}.shape.gii" ] || [ -f "${outName}.triu.npy" ]; then
     Info "Geodesic Distance vertex-wise on fsLR-5k already exists"; ((Nsteps++)); ((N++))
 else
     Info "Computing Geodesic Distance vertex-wise from surface fsLR-5k"; ((N++))
     Do_cmd "$MICAPIPE"/functions/geoDistMapper.py -lh_surf "$lh_fdLR5k" -rh_surf "$rh_fdLR5k" -outPath "$outName"
-    if [[ -f "${outName}.shape.gii" ]]; then ((Nsteps++)); fi
+    if [[ -f "${outName}_hemi-L.triu.npy" ]] && [[ -f "${outName}_hemi-R.triu.npy" ]]; then ((Nsteps++)); fi
 fi
 
 # Compute geodesic distance on all parcellations
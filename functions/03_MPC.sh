@@ -27,7 +27,9 @@ input_im=$8
 mpc_reg=$9
 mpc_str=${10}
 synth_reg=${11}
-PROC=${12}
+mpc_vertex32k=${12}
+mpc_gradients=${13}
+PROC=${14}
 export OMP_NUM_THREADS=$threads
 here=$(pwd)
 
@@ -52,6 +54,92 @@ post_struct_json="${proc_struct}/${idBIDS}_post_structural.json"
 recon=$(grep SurfRecon "${post_struct_json}" | awk -F '"' '{print $4}')
 set_surface_directory "${recon}"
 
+# Number of intracortical surfaces
+num_surfs=14
+
+function equivolumetric_surfaces() {
+  # Equivolumetric intracortical surfaces without the FreeSurfer offset-to-origin:
+  #   <surf_dir>/<hemi>.<n>by<num_surfs>_no_offset.surf.gii
+  # They only depend on the structural data and are shared by all the acquisitions
+  local surf_dir=$1
+  local scratch=$2
+  if [[ -f "${surf_dir}/rh.${num_surfs}by${num_surfs}_no_offset.surf.gii" ]]; then return; fi
+  mkdir -p "$surf_dir"
+  for hemi in lh rh ; do
+      unset LD_LIBRARY_PATH
+      tot_surfs=$((num_surfs + 2))
+      Do_cmd python "$MICAPIPE"/functions/generate_equivolumetric_surfaces.py \
+          "${dir_subjsurf}/surf/${hemi}.pial" \
+          "${dir_subjsurf}/surf/${hemi}.white" \
+          "$tot_surfs" \
+          "${surf_dir}/${hemi}.${num_surfs}surfs" \
+          "$scratch" \
+          --software freesurfer --subject_id "$idBIDS"
+
+      # remove top and bottom surface
+      Do_cmd rm -rfv "${surf_dir}/${hemi}.${num_surfs}surfs0.0.pial" "${surf_dir}/${hemi}.${num_surfs}surfs1.0.pial"
+
+      # find all equivolumetric surfaces and list by creation time
+      x=$(ls -t "$surf_dir"/"$hemi".${num_surfs}surfs*)
+      for n in $(seq 1 1 "$num_surfs") ; do
+          which_surf=$(sed -n "$n"p <<< "$x")
+          surf_gii="${scratch}/${hemi}.${n}by${num_surfs}_space-fsnative.surf.gii"
+          Do_cmd mris_convert "$which_surf" "${surf_gii}"
+          # Remove offset-to-origin from any gifti surface derived from FS
+          Do_cmd python "$MICAPIPE"/functions/removeFSoffset.py "${surf_gii}" "${surf_dir}/${hemi}.${n}by${num_surfs}_no_offset.surf.gii"
+          rm "${surf_gii}" "${which_surf}"
+      done
+  done
+}
+
+#------------------------------------------------------------------------------#
+# Batch mode: comma separated acquisitions (-mpc_acq T1map,MTsat) with their images
+# (-microstructural_img and -microstructural_reg, a single value is used for all the acquisitions).
+# The intracortical surfaces are generated once, then each acquisition is processed
+# by its own 03_MPC.sh run, concurrently, with its share of the threads.
+if [[ "${mpc_str}" == *,* ]]; then
+  IFS=',' read -ra acq_list <<< "${mpc_str}"
+  IFS=',' read -ra img_list <<< "${input_im}"
+  IFS=',' read -ra reg_list <<< "${mpc_reg}"
+  n_acq=${#acq_list[@]}
+  for list in "${#img_list[@]}" "${#reg_list[@]}"; do
+    if [[ "$list" -ne 1 ]] && [[ "$list" -ne "$n_acq" ]]; then
+      Error "MPC batch mode: -microstructural_img and -microstructural_reg need one image, or one per acquisition (${mpc_str})"; exit 1
+    fi
+  done
+  acq_threads=$(( threads / n_acq )); if [[ "$acq_threads" -lt 1 ]]; then acq_threads=1; fi
+  Title "Microstructural Profiles Covariance - batch of ${n_acq} acquisitions\n\t\tmicapipe $Version, $PROC"
+  Note "Acquisitions :" "${acq_list[*]}"
+  Note "Threads per acquisition :" "${acq_threads}"
+
+  tmp="${tmpDir}/${RANDOM}_micapipe_post-MPC-batch_${id}"
+  Do_cmd mkdir -p "$tmp"
+  trap 'cleanup $tmp $nocleanup $here' SIGINT SIGTERM
+  export SUBJECTS_DIR="$dir_surf"
+  export MICAPIPE_MPC_SURFS="${tmp}/equivolumetric"
+  Info "Generating the intracortical surfaces shared by all the acquisitions"
+  equivolumetric_surfaces "$MICAPIPE_MPC_SURFS" "$tmp"
+
+  pids=()
+  for i in "${!acq_list[@]}"; do
+    img=${img_list[0]}; [[ ${#img_list[@]} -gt 1 ]] && img=${img_list[$i]}
+    reg=${reg_list[0]}; [[ ${#reg_list[@]} -gt 1 ]] && reg=${reg_list[$i]}
+    acq_log="${dir_logs}/MPC-${acq_list[$i]}_$(date +'%d-%m-%Y')-${RANDOM}.txt"
+    Info "Running MPC on ${acq_list[$i]}, log: ${acq_log}"
+    "$MICAPIPE"/functions/03_MPC.sh "$BIDS" "$id" "$out" "$SES" "$nocleanup" "$acq_threads" "$tmpDir" "$img" "$reg" \
+        "${acq_list[$i]}" "$synth_reg" "$mpc_vertex32k" "$mpc_gradients" "$PROC" > "${acq_log}" 2>&1 &
+    pids+=($!)
+  done
+  n_failed=0
+  for i in "${!pids[@]}"; do
+    if wait "${pids[$i]}"; then Info "MPC ${acq_list[$i]} finished"
+    else Warning "MPC ${acq_list[$i]} failed, check its log"; ((n_failed++)); fi
+  done
+  cleanup "$tmp" "$nocleanup" "$here"
+  if [[ "$n_failed" -gt 0 ]]; then exit 1; fi
+  exit 0
+fi
+
 # Variables naming for multiple acquisitions
 if [[ "${mpc_str}" == DEFAULT ]]; then
   mpc_str="qMRI"
@@ -85,6 +173,8 @@ Note "Parallel processing : " "${threads} threads"
 Note "tmp dir   : " "${tmpDir}"
 Note "recon     : " "${recon}"
 Note "synth_reg : " ${synth_reg}
+Note "MPC vertex 32k : " "${mpc_vertex32k}"
+Note "MPC gradients  : " "${mpc_gradients}"
 
 #	Timer
 aloita=$(date +%s)
@@ -145,47 +235,47 @@ Do_cmd c3d_affine_tool -itk "$qT1_fsnative_affine" -inv -o "${wb_affine}"
 
 ##------------------------------------------------------------------------------#
 ## Register qT1 intensity to surface
-num_surfs=14
 [[ ! -d "$outDir" ]] && mkdir -p "$outDir" && chmod -R 770 "$outDir"
 json_mpc "$microImage" "${outDir}/${idBIDS}_MPC-${mpc_str}.json"
 
 MPC_fsLR5k="${outDir}/${idBIDS}_surf-fsLR-5k_desc-MPC.shape.gii"
-if [[ ! -f "${MPC_fsLR5k}" ]]; then ((N++))
+# One intensity-profile cube per surface space (depth x vertex, both hemispheres)
+Ncubes=$(ls "${outDir}/${idBIDS}"_surf-*_desc-intensity_profiles.cube.npz 2>/dev/null | wc -l)
+# Per-depth profiles of the previous layout (4 surface spaces x 2 hemispheres x num_surfs depths)
+Nlegacy=$(ls "${outDir}/${idBIDS}"_hemi-*_surf-*_label-MPC-*.func.gii 2>/dev/null | wc -l)
+if [[ "$Ncubes" -lt 4 ]] && [[ "$Nlegacy" -ge $((8 * num_surfs)) ]]; then ((N++))
+    Info "Packing the existing per-depth intensity profiles into cubes"
+    Do_cmd python "$MICAPIPE"/functions/profile_cube.py -legacy "$outDir" "$idBIDS" "$num_surfs"
+    ((Nsteps++))
+elif [[ "$Ncubes" -lt 4 ]]; then ((N++))
+    # Intracortical surfaces, shared with the other acquisitions in batch mode
+    surf_dir="${MICAPIPE_MPC_SURFS:-${tmp}/equivolumetric}"
+    equivolumetric_surfaces "$surf_dir" "$tmp"
     for hemi in lh rh ; do
         [[ "$hemi" == lh ]] && HEMI=L || HEMI=R
-        unset LD_LIBRARY_PATH
-        tot_surfs=$((num_surfs + 2))
-        Do_cmd python "$MICAPIPE"/functions/generate_equivolumetric_surfaces.py \
-            "${dir_subjsurf}/surf/${hemi}.pial" \
-            "${dir_subjsurf}/surf/${hemi}.white" \
-            "$tot_surfs" \
-            "${outDir}/${hemi}.${num_surfs}surfs" \
-            "$tmp" \
-            --software freesurfer --subject_id "$idBIDS"
-
-        # remove top and bottom surface
-        Do_cmd rm -rfv "${outDir}/${hemi}.${num_surfs}surfs0.0.pial" "${outDir}/${hemi}.${num_surfs}surfs1.0.pial"
-
-        # find all equivolumetric surfaces and list by creation time
-        x=$(ls -t "$outDir"/"$hemi".${num_surfs}surfs*)
+        feat_merge=()
         for n in $(seq 1 1 "$num_surfs") ; do
-            which_surf=$(sed -n "$n"p <<< "$x")
-            surf_gii="${tmp}/${hemi}.${n}by${num_surf}_space-fsnative.surf.gii"
-            surf_tmp="${tmp}/${hemi}.${n}by${num_surf}_no_offset.surf.gii"
-            out_surf="${tmp}/${hemi}.${n}by${num_surf}_space-qMRI.surf.gii"
-            out_feat="${outDir}/${idBIDS}_hemi-${HEMI}_surf-fsnative_label-MPC-${n}.func.gii"
-            # Register surface to qMRI space
-            Do_cmd mris_convert "$which_surf" "${surf_gii}"
-            # Remove offset-to-origin from any gifti surface derived from FS
-            Do_cmd python "$MICAPIPE"/functions/removeFSoffset.py "${surf_gii}" "${surf_tmp}"
+            surf_tmp="${surf_dir}/${hemi}.${n}by${num_surfs}_no_offset.surf.gii"
+            out_surf="${tmp}/${hemi}.${n}by${num_surfs}_space-qMRI.surf.gii"
+            out_feat="${tmp}/${idBIDS}_hemi-${HEMI}_surf-fsnative_label-MPC-${n}.func.gii"
             # Apply transformation to register surface to nativepro
             Do_cmd wb_command -surface-apply-affine "${surf_tmp}" "${wb_affine}" "${out_surf}"
-            # Sample intensity and resample to other surfaces
-            map_to-surfaces "${microImage}" "${out_surf}" "${out_feat}" "${HEMI}" "MPC-${n}" "${outDir}"
-            # remove tmp surfaces
-            rm "${surf_tmp}" "${which_surf}"
+            # Sample intensity on fsnative
+            Do_cmd wb_command -volume-to-surface-mapping "${microImage}" "${out_surf}" "${out_feat}" -trilinear
+            feat_merge+=(-metric "${out_feat}")
+        done
+        # Merge the depths in one multi-map file and resample it once to the other surfaces
+        mpc_fsnative="${tmp}/${idBIDS}_hemi-${HEMI}_surf-fsnative_desc-MPC.func.gii"
+        Do_cmd wb_command -metric-merge "${mpc_fsnative}" "${feat_merge[@]}"
+        for Surf in "fsLR-32k" "fsaverage5" "fsLR-5k"; do
+            Do_cmd wb_command -metric-resample "${mpc_fsnative}" \
+                "${dir_conte69}/${idBIDS}_hemi-${HEMI}_surf-fsnative_label-sphere.surf.gii" \
+                "${util_surface}/${Surf}.${HEMI}.sphere.reg.surf.gii" \
+                BARYCENTRIC "${tmp}/${idBIDS}_hemi-${HEMI}_surf-${Surf}_desc-MPC.func.gii"
         done
     done
+    # Pack the scratch files into one compressed intensity-profile cube per surface space
+    Do_cmd python "$MICAPIPE"/functions/profile_cube.py "$tmp" "$outDir" "$idBIDS" "$num_surfs"
     ((Nsteps++))
 else
     Info "Subject ${id} has microstructural intensities mapped to native surface";((Nsteps++)); ((N++));
@@ -240,26 +330,37 @@ fi
 
 #------------------------------------------------------------------------------#
 # Create MPC connectomes and Intensity profiles per parcellations
+# All the missing parcellations are processed by a single surf2mpc.py call (intensity profiles loaded once)
+# Number of diffusion-map gradients of each MPC (0: none)
+if [[ "$mpc_gradients" == "TRUE" ]]; then n_gradients=10; else n_gradients=0; fi
 parcellations=($(find "$dir_volum" -name "*atlas*" ! -name "*cerebellum*" ! -name "*subcortical*"))
+parc_todo=()
 for seg in "${parcellations[@]}"; do
     parc=$(echo "${seg/.nii.gz/}" | awk -F 'atlas-' '{print $2}')
-    parc_annot="${parc}_mics.annot"
     MPC_int="${outDir}/${idBIDS}_atlas-${parc}_desc-intensity_profiles.shape.gii"
-    if [[ ! -f "$MPC_int" ]]; then ((N++))
-        Info "Running MPC on $parc"
-        Do_cmd python "$MICAPIPE"/functions/surf2mpc.py "$out" "$id" "$SES" "$num_surfs" "$parc_annot" "$dir_subjsurf" "${mpc_p}"
-        if [[ -f "$MPC_int" ]]; then ((Nsteps++)); fi
+    if [[ ! -f "$MPC_int" ]]; then ((N++)); parc_todo+=("${parc}")
     else Info "Subject ${id} has MPC connectome and intensity profile on ${parc}"; ((Nsteps++)); ((N++)); fi
 done
+if [[ ${#parc_todo[@]} -gt 0 ]]; then
+    Info "Running MPC on ${parc_todo[*]}"
+    parc_annots=$(printf "%s_mics.annot," "${parc_todo[@]}")
+    Do_cmd python "$MICAPIPE"/functions/surf2mpc.py "$out" "$id" "$SES" "$num_surfs" "${parc_annots%,}" "$dir_subjsurf" "${mpc_p}" "$n_gradients"
+    for parc in "${parc_todo[@]}"; do
+        if [[ -f "${outDir}/${idBIDS}_atlas-${parc}_desc-intensity_profiles.shape.gii" ]]; then ((Nsteps++)); fi
+    done
+fi
 
 #------------------------------------------------------------------------------#
 # Create vertex-wise MPC connectome and directory cleanup
-if [[ ! -f "${MPC_fsLR5k}" ]]; then ((N++))
+if [[ ! -f "${MPC_fsLR5k}" ]] && [[ ! -f "${MPC_fsLR5k/.shape.gii/.triu.npy}" ]]; then ((N++))
   Info "Running MPC vertex-wise on fsLR-5k"
-  Do_cmd python "$MICAPIPE"/functions/build_mpc-vertex.py "$out" "$id" "$SES" "${mpc_p}"
+  if [[ "$mpc_vertex32k" == "TRUE" ]]; then mpc_opts=(-vertex32k -threads "$threads"); else mpc_opts=(); fi
+  mpc_opts+=(-gradients "$n_gradients")
+  Do_cmd python "$MICAPIPE"/functions/build_mpc-vertex.py "$out" "$id" "$SES" "${mpc_p}" "${mpc_opts[@]}"
   ((Nsteps++))
 else Info "Subject ${id} has MPC vertex-wise on fsLR-5k"; ((Nsteps++)); ((N++)); fi
-rm "${dir_warp}/${idBIDS}"*_Warped.nii.gz
+# Only this acquisition's registration output (batch mode runs the acquisitions concurrently)
+rm -f "${mat_fsnative_affine}"Warped.nii.gz
 
 #------------------------------------------------------------------------------#
 # QC notification of completition
@@ -269,6 +370,10 @@ eri=$(echo print "$eri"/60 | perl)
 
 # Notification of completition
 micapipe_completition_status "MPC"
-micapipe_procStatus "${id}" "${SES/ses-/}" "MPC-${mpc_str}" "${out}/micapipe_processed_sub.csv"
+# The acquisitions of a batch update the processed-modules CSV one at a time
+(
+  flock -w 300 9 || Warning "Could not lock ${out}/micapipe_processed_sub.csv"
+  micapipe_procStatus "${id}" "${SES/ses-/}" "MPC-${mpc_str}" "${out}/micapipe_processed_sub.csv"
+) 9>"${out}/.micapipe_processed_sub.csv.lock"
 Do_cmd micapipe_procStatus_json "${id}" "${SES/ses-/}" "MPC-${mpc_str}" "${module_json}"
 cleanup "$tmp" "$nocleanup" "$here"
@@ -233,7 +233,7 @@ for seg in "${parcellations[@]}"; do
     dwi_all="${tmp}/${id}_${parc_name}-full_dwi.nii.gz"
     # -----------------------------------------------------------------------------------------------
     # Build the Full connectome (Cortical-Subcortical-Cerebellar)
-    if [[ ! -f "${connectome_str}_full-connectome.shape.gii" ]]; then ((N++))
+    if [[ ! -f "${connectome_str}_full-connectome.shape.gii" ]] && [[ ! -f "${connectome_str}_full-connectome.triu.npy" ]]; then ((N++))
         Info "Building $parc_name cortical-subcortical-cerebellum connectome"
         # Take parcellation into DWI space
         Do_cmd antsApplyTransforms -d 3 -e 3 -i "$seg" -r "${fod}" -n GenericLabel "$trans_T12dwi" -o "$dwi_cortex" -v -u int
@@ -243,7 +243,7 @@ for seg in "${parcellations[@]}"; do
         Do_cmd fslmaths "$dwi_cortex" -binv -mul "$dwi_cere" -add "$dwi_cortexSub" "$dwi_all" -odt int # added the cerebellar parcellation
         # Build the Cortical-Subcortical-Cerebellum connectomes
         build_connectomes "$dwi_all" "${connectome_str}_full"
-        if [[ -f "${connectome_str}_full-connectome.shape.gii" ]]; then ((Nsteps++)); fi
+        if [[ -f "${connectome_str}_full-connectome.shape.gii" ]] || [[ -f "${connectome_str}_full-connectome.triu.npy" ]]; then ((Nsteps++)); fi
     else
         ((N++)); ((Nsteps++))
     fi
@@ -56,6 +56,7 @@ from brainspace.utils.parcellation import map_to_labels
 from brainspace.vtk_interface import wrap_vtk, serial_connect
 from vtk import vtkPolyDataNormals
 from pyvirtualdisplay import Display
+from packed_connectome import PackedConnectome, load_connectome
 
 # Arguments
 parser = argparse.ArgumentParser()
@@ -1116,7 +1117,7 @@ def qc_proc_func(proc_func_json=''):
     )
 
     fc_file = "%s/func/desc-%s/surf/%s_surf-fsLR-5k_desc-FC.shape.gii"%(subj_dir,tag,sbids)
-    fc = nb.load(fc_file).darrays[0].data
+    fc = load_connectome(fc_file)
     np.seterr(divide='ignore')
     fcz = np.arctanh(fc)
     fcz[~np.isfinite(fcz)] = 0
@@ -1158,8 +1159,8 @@ def qc_proc_func(proc_func_json=''):
         fc_file = "%s/func/desc-%s/surf/%s_surf-fsLR-32k_atlas-%s_desc-FC.shape.gii"%(subj_dir,tag,sbids,annot)
 
         # Load shape.gii
-        if os.path.isfile(fc_file):
-            fc_mtx = nb.load(fc_file).darrays[0].data
+        if os.path.isfile(fc_file) or PackedConnectome.exists(fc_file):
+            fc_mtx = load_connectome(fc_file)
             fc = fc_mtx[49:, 49:]
             fcz = np.arctanh(fc)
             fcz[~np.isfinite(fcz)] = 0
@@ -1200,7 +1201,7 @@ def qc_proc_func(proc_func_json=''):
     )
 
     fc_file = "%s/func/desc-%s/surf/%s_surf-fsLR-32k_atlas-schaefer-400_desc-FC.shape.gii"%(subj_dir,tag,sbids)
-    fc_mtx = nb.load(fc_file).darrays[0].data
+    fc_mtx = load_connectome(fc_file)
     fc = fc_mtx[49:, 49:]
     fcz = np.arctanh(fc)
     fcz[~np.isfinite(fcz)] = 0
@@ -1317,7 +1318,7 @@ def qc_sc(sc_json=''):
 
     for connectomeType in connectomes:
         c_file = f"{subj_dir}/{dwi_dir}/connectomes/{sbids}_surf-fsLR-5k_desc-iFOD2-{streamlines}-SIFT2_{connectomeType}.shape.gii"
-        c = nb.load(c_file).darrays[0].data
+        c = load_connectome(c_file)
         c = np.log(np.triu(c,1)+c.T)
         c[np.isneginf(c)] = 0
         c[c==0] = np.finfo(float).eps
@@ -1349,7 +1350,7 @@ def qc_sc(sc_json=''):
 
             c_fig = tmpDir + "/" + sbids + "space-dwi_atlas-" + annot + "_desc-iFOD2-" + streamlines + "SIFT2_" + connectomeType + ".png"
             c_file = f"{subj_dir}/{dwi_dir}/connectomes/{sbids}_space-dwi_atlas-{annot}_desc-iFOD2-{streamlines}-SIFT2_{connectomeType}.shape.gii"
-            c = nb.load(c_file).darrays[0].data
+            c = load_connectome(c_file)
             c = np.log(np.triu(c,1)+c.T)
             c[np.isneginf(c)] = 0
             c[c==0] = np.finfo(float).eps
@@ -1465,7 +1466,7 @@ def qc_mpc(mpc_json=''):
     )
 
     mpc_file = "%s/mpc/acq-%s/%s_surf-fsLR-5k_desc-MPC.shape.gii"%(subj_dir,acquisition,sbids)
-    mpc = nb.load(mpc_file).darrays[0].data
+    mpc = load_connectome(mpc_file)
     mpc = np.triu(mpc,1)+mpc.T
     mpc[~np.isfinite(mpc)] = np.finfo(float).eps
     mpc[mpc==0] = np.finfo(float).eps
@@ -1509,7 +1510,7 @@ def qc_mpc(mpc_json=''):
         # Intensity profiles
         ip_fig = tmpDir + "/" + sbids + "_atlas-" + annot + "_desc-" + acquisition + "_intensity_profiles.png"
         ip_file = "%s/mpc/acq-%s/%s_atlas-%s_desc-intensity_profiles.shape.gii"%(subj_dir,acquisition,sbids,annot)
-        ip = nb.load(ip_file).darrays[0].data
+        ip = load_connectome(ip_file)
         pltpy.imshow(ip, cmap="crest", aspect='auto')
         pltpy.savefig(ip_fig)
 
@@ -1519,7 +1520,7 @@ def qc_mpc(mpc_json=''):
 
         mpc_fig = tmpDir + "/" + sbids + "_atlas-" + annot + "_desc-" + acquisition + "_mpc.png"
         mpc_file = "%s/mpc/acq-%s/%s_atlas-%s_desc-MPC.shape.gii"%(subj_dir,acquisition,sbids,annot)
-        mpc = nb.load(mpc_file).darrays[0].data
+        mpc = load_connectome(mpc_file)
         mpc = np.triu(mpc,1)+mpc.T
         mpc = np.delete(np.delete(mpc, 0, axis=0), 0, axis=1)
         mpc = np.delete(np.delete(mpc, Ndim, axis=0), Ndim, axis=1)
@@ -1585,9 +1586,13 @@ def qc_gd(gd_json=''):
             '<b>GD connectomes</b> </p>'
     )
 
-    gd_file = "%s/dist/%s_surf-fsLR-5k_GD.shape.gii"%(subj_dir,sbids)
-    gd = nb.load(gd_file).darrays[0].data
-    deg = np.sum(gd,axis=1)
+    gd_file = "%s/dist/%s_surf-fsLR-5k_GD"%(subj_dir,sbids)
+    if PackedConnectome.exists(gd_file + "_hemi-L.triu.npy"):
+        # One packed upper triangle per hemisphere (the cross-hemisphere blocks are zero)
+        deg = np.concatenate([np.sum(PackedConnectome(gd_file + "_hemi-%s.triu.npy"%(hemi)).square(mirror=True), axis=1) for hemi in ['L', 'R']])
+    else:
+        gd = load_connectome(gd_file + ".shape.gii")
+        deg = np.sum(gd,axis=1)
     deg_fig = tmpDir + "/" + sbids + "surf-fsLR-5k_GD_degree.png"
 
     display = Display(visible=0, size=(900, 250))
@@ -1629,7 +1634,7 @@ def qc_gd(gd_json=''):
 
         gd_fig = tmpDir + "/" + sbids + "_atlas-" + annot + "_gd.png"
         gd_file = "%s/dist/%s_atlas-%s_GD.shape.gii"%(subj_dir,sbids,annot)
-        gd = nb.load(gd_file).darrays[0].data
+        gd = load_connectome(gd_file)
         pltpy.imshow(gd, cmap="Blues", aspect='auto')
         pltpy.savefig(gd_fig)
 
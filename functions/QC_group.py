@@ -78,6 +78,7 @@ from matplotlib.cm import Spectral
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 from pyvirtualdisplay import Display
+from packed_connectome import load_connectome
 
 
 # Arguments
@@ -199,11 +200,8 @@ def upper_tri_indexing(A):
 def load_mpc(File, Ndim):
     """Loads and process a MPC"""
 
-    # load the matrix
-    mtx_mpc = nb.load(File).darrays[0].data
-
-    # Mirror the matrix
-    MPC = np.triu(mtx_mpc,1)+mtx_mpc.T
+    # load the matrix and mirror it (packed format if available)
+    MPC = load_connectome(File, mirror=True)
 
     # Remove the medial wall
     MPC = np.delete(np.delete(MPC, 0, axis=0), 0, axis=1)
@@ -215,7 +213,7 @@ def load_gd(File, Ndim):
     """Loads and process a GD"""
 
     # load the matrix
-    mtx_gd = nb.load(File).darrays[0].data
+    mtx_gd = load_connectome(File)
 
     # Remove the Mediall Wall
     mtx_gd = np.delete(np.delete(mtx_gd, 0, axis=0), 0, axis=1)
@@ -226,8 +224,8 @@ def load_gd(File, Ndim):
 def load_fc(File, Ndim, parc=''):
     """Loads and process a functional connectome"""
 
-    # load the matrix
-    mtx_fs = nb.load(File).darrays[0].data
+    # load the mirrored matrix (packed format if available)
+    mtx_fs = load_connectome(File, mirror=True)
 
     # slice the matrix remove subcortical nodes and cerebellum
     FC = mtx_fs[49:, 49:]
@@ -237,19 +235,13 @@ def load_fc(File, Ndim, parc=''):
 
     # replace inf with 0
     FCz[~np.isfinite(FCz)] = 0
-
-    # Mirror the matrix
-    FCz = np.triu(FCz,1)+FCz.T
     return FCz
 
 def load_sc(File, Ndim):
     """Loads and process a structura connectome"""
 
-    # load the matrix
-    mtx_sc = nb.load(File).darrays[0].data
-
-    # Mirror the matrix
-    mtx_sc = np.log(np.triu(mtx_sc,1)+mtx_sc.T)
+    # load the mirrored matrix (packed format if available)
+    mtx_sc = np.log(load_connectome(File, mirror=True))
     mtx_sc[np.isneginf(mtx_sc)] = 0
 
     # slice the matrix remove subcortical nodes and cerebellum
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Decoding of FreeSurfer annotations into micapipe parcel vectors.
+
+The annotation values of each vertex (read with orig_ids=True) are mapped to
+the index of their label in the color table, the right hemisphere is offset
+by the number of labels of the left one:
+
+    parc[v] = first row of ctab[:, 4] equal to the annotation value of v
+
+The mapping is a single searchsorted on the sorted color table ids instead of
+one np.where per vertex. Decoded parcellations and parcel centroids are cached
+as small npz files, keyed on the annotation (and surface) paths and their
+modification times, in the first writable of: $MICAPIPE_CACHE/annot,
+~/.cache/micapipe/annot (the label directories are often read-only or shared).
+The annotations of micapipe are per subject (<surf dir>/label), so the cache
+is per subject and annotation.
+
+    Functions
+    ---------
+    decode_annot    : parcel indices of one hemisphere
+    load_annot      : parcel vector of both hemispheres (cached)
+    mpc_exclude_labels : medial wall / corpus callosum nodes excluded from the MPC
+    parcel_centroids : centroid vertex of each parcel on a pair of surfaces (cached)
+"""
+
+import os
+import hashlib
+import tempfile
+import numpy as np
+import nibabel as nb
+from parcel_kernel import SegmentedParcellation
+
+
+def decode_annot(labels, ctab):
+    """ Index of the color table row of each vertex annotation value.
+
+    Parameters
+    ----------
+    labels : array (vertices), annotation values (nb.freesurfer.read_annot(..., orig_ids=True))
+    ctab : array (labels x 5), color table, column 4 holds the annotation values
+
+    Return
+    ------
+    parc : array of int32 (vertices)
+    """
+    ids = ctab[:, 4]
+    # First row of each id, as np.where(ctab[:, 4] == label)[0][0]
+    uids, first = np.unique(ids, return_index=True)
+    pos = np.minimum(np.searchsorted(uids, labels), len(uids) - 1)
+    missing = uids[pos] != labels
+    if np.any(missing):
+        raise ValueError('Annotation values not found in the color table: {}'.format(np.unique(labels[missing])[:10]))
+    return first[pos].astype(np.int32)
+
+
+def _cache_dirs():
+    dirs = []
+    if 'MICAPIPE_CACHE' in os.environ:
+        dirs.append(os.path.join(os.environ['MICAPIPE_CACHE'], 'annot'))
+    dirs.append(os.path.join(os.path.expanduser('~'), '.cache', 'micapipe', 'annot'))
+    return dirs
+
+
+def _cache_name(lh_annot, *files, desc=''):
+    key = '|'.join('{}:{}:{}'.format(os.path.abspath(f), os.stat(f).st_mtime_ns, os.stat(f).st_size)
+                   for f in (lh_annot,) + files)
+    name = os.path.basename(lh_annot).replace('lh.', '', 1).replace('.annot', '') + desc
+    return '{}_{}.npz'.format(name, hashlib.sha1(key.encode()).hexdigest()[:16])
+
+
+def _read_cache(dirs, fname):
+    for cacheDir in dirs:
+        cached = os.path.join(cacheDir, fname)
+        if os.path.isfile(cached):
+            try:
+                with np.load(cached) as npz:
+                    return {key: npz[key] for key in npz.files}
+            except (OSError, ValueError):
+                pass
+    return None
+
+
+def _write_cache(dirs, fname, **arrays):
+    # Atomic write: several parcellations can be decoded at once
+    for cacheDir in dirs:
+        try:
+            os.makedirs(cacheDir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(suffix='.npz', dir=cacheDir)
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, **arrays)
+            os.replace(tmp, os.path.join(cacheDir, fname))
+            return
+        except OSError:
+            continue
+    print('[WARNING]... annotation cache is not writable, ' + fname + ' was not cached')
+
+
+def load_annot(lh_annot, rh_annot, cache=True):
+    """ Parcel vector of both hemispheres from a pair of annotation files.
+
+    Parameters
+    ----------
+    lh_annot, rh_annot : str, paths to the annotation files
+    cache : bool, read/write the decoded parcellation cache
+
+    Return
+    ------
+    parc : array of int32 (lh + rh vertices), right labels offset by the size of the left color table
+    n_lh : int, number of vertices of the left hemisphere
+    names_lh : list of str, label names of the left hemisphere
+    """
+    dirs = _cache_dirs()
+    fname = _cache_name(lh_annot, rh_annot)
+    if cache:
+        cached = _read_cache(dirs, fname)
+        if cached is not None and {'parc', 'n_lh', 'names_lh'} <= set(cached):
+            return cached['parc'], int(cached['n_lh']), list(cached['names_lh'])
+    labels_lh, ctab_lh, names_lh = nb.freesurfer.io.read_annot(lh_annot, orig_ids=True)
+    labels_rh, ctab_rh, _ = nb.freesurfer.io.read_annot(rh_annot, orig_ids=True)
+    parc = np.concatenate((decode_annot(labels_lh, ctab_lh), decode_annot(labels_rh, ctab_rh) + len(ctab_lh)))
+    names_lh = [name.decode() for name in names_lh]
+    if cache:
+        _write_cache(dirs, fname, parc=parc, n_lh=len(labels_lh), names_lh=np.array(names_lh))
+    return parc, len(labels_lh), names_lh
+
+
+def mpc_exclude_labels(parc_name, names_lh, n_parcels):
+    """ Nodes excluded from the MPC: medial wall and corpus callosum.
+
+    Some hardcoded things to deal with label naming specific to aparc and aparc-a2009s...
+    Glasser, vosdewael, and Schaefer all have medial wall at same place (first label of each hemisphere).
+
+    Parameters
+    ----------
+    parc_name : str, annotation name (e.g. aparc_mics.annot)
+    names_lh : list of str, label names of the left hemisphere
+    n_parcels : int, number of parcels of both hemispheres
+
+    Return
+    ------
+    exclude_labels : array of int
+    """
+    parcShortName = parc_name.replace("_mics.annot", "")
+    half = int(n_parcels/2)
+    if parcShortName == 'aparc':
+        # Exclude corpus callosum plus medial wall ("unknown")
+        exclude_labels = [[i, i + half] for i, name in enumerate(names_lh) if name in ['corpuscallosum', 'unknown']]
+    elif parcShortName == 'aparc-a2009s':
+        # Exclude pericallosal plus medial wall.
+        # The label "unknown" is not represented in the parcellation.
+        # For this reason we have to adjust the label numbers by subtracting 1
+        exclude_labels = [[i - 1, i + half - 1] for i, name in enumerate(names_lh)
+                          if name in ['S_pericallosal', 'G_subcallosal', 'Medial_wall']]
+    else:
+        exclude_labels = [[0, half]]
+    return np.asarray(exclude_labels, dtype=int).ravel()
+
+
+def parcel_centroids(lh_surf, rh_surf, lh_annot, rh_annot, cache=True):
+    """ Centroid vertex of each parcel: minimum summed Euclidean distance to the
+    other vertices of the parcel (SegmentedParcellation.centroids).
+
+    Parameters
+    ----------
+    lh_surf, rh_surf : str, paths to the surfaces (GIFTI) of the annotations
+    lh_annot, rh_annot : str, paths to the annotation files
+    cache : bool, read/write the centroid cache (keyed on the surfaces and the annotations)
+
+    Return
+    ------
+    centroids : array of int (parcels), vertex index (lh + rh vertices) of each parcel, in np.unique(parc) order
+    """
+    dirs = _cache_dirs()
+    fname = _cache_name(lh_annot, rh_annot, lh_surf, rh_surf, desc='_centroids')
+    if cache:
+        cached = _read_cache(dirs, fname)
+        if cached is not None and 'centroids' in cached:
+            return cached['centroids']
+    parc, _, _ = load_annot(lh_annot, rh_annot, cache=cache)
+    vertices = np.concatenate([nb.load(f).agg_data('NIFTI_INTENT_POINTSET') for f in [lh_surf, rh_surf]])
+    centroids = SegmentedParcellation(parc).centroids(vertices)
+    if cache:
+        _write_cache(dirs, fname, centroids=centroids)
+    return centroids
@@ -3,8 +3,15 @@
 
 """
 1. Saves surfaces func.gii with the intensities mapped as a matrix
-  for each surface template {fsnative,fsaverage5, fsLR-5k, fsLR-32k}
+  for each surface template {fsnative,fsaverage5, fsLR-5k, fsLR-32k},
+  read from the intensity-profile cubes (profile_cube.py). The surface spaces
+  are processed in parallel threads (OMP_NUM_THREADS), with their timing and
+  bytes read reported
 2. Creates a vertex-wise MPC from fsLR-5k
+3. Optional: creates a vertex-wise MPC from fsLR-32k (tiled, out-of-core),
+   saved as the packed upper triangle <bids_id>_surf-fsLR-32k_desc-MPC.triu.npy
+4. Optional: diffusion-map gradients of the fsLR-5k MPC (diffusion_map.py),
+   saved as <bids_id>_surf-fsLR-5k_desc-MPCgradients.shape.gii
 
     Parameters
     ----------
@@ -12,24 +19,39 @@
 
     Usage
     -----
-    build_mpc-vertex.py "$out" "$id" "$SES" "${mpc_p}"
+    build_mpc-vertex.py "$out" "$id" "$SES" "${mpc_p}" [-vertex32k] [-mem GB] [-threads N] [-gradients N]
 
 @author: rcruces
 """
 
 # Import packages
-import sys
 import os
 import glob
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import nibabel as nb
-from build_mpc import build_mpc
+from build_mpc import build_mpc, save_tiled_mpc
+from diffusion_map import mpc_gradients, save_gradients
+from gifti_io import n_threads_default
+from profile_cube import load_profiles, profile_files
+from packed_connectome import save_connectome
 
 # Define input arguments
-dataDir = sys.argv[1]
-sub = sys.argv[2]
-ses_num = sys.argv[3]
-acq = sys.argv[4]
+parser = argparse.ArgumentParser()
+for arg in ['dataDir', 'sub', 'ses_num', 'acq']:
+    parser.add_argument(arg)
+parser.add_argument('-vertex32k', default=False, action='store_true',
+                    help='Compute the vertex-wise fsLR-32k MPC (tiled, out-of-core)')
+parser.add_argument('-mem', type=float, default=8, help='Memory ceiling in GB of each tile of the fsLR-32k MPC')
+parser.add_argument('-threads', type=int, default=None, help='Number of BLAS threads of the fsLR-32k MPC')
+parser.add_argument('-gradients', type=int, default=0, help='Number of diffusion-map gradients of the fsLR-5k MPC (default 0: none)')
+args = parser.parse_args()
+dataDir = args.dataDir
+sub = args.sub
+ses_num = args.ses_num
+acq = args.acq
 
 def save_gii(data_array, file_name):
     # Initialize gifti: NIFTI_INTENT_SHAPE - 2005, FLOAT32 - 16
@@ -58,39 +80,66 @@ if acq=="DEFAULT":
 else:
     OPATH = "{subject_dir}/mpc/{acq}/".format(subject_dir=ses_str, acq=acq)
 
-# Load all the surfaces and create a numpy.array
-def get_hemisphere(surface_number, hemi, surf):
-    thisname_gii = "{output}{bids_id}_hemi-{hemi}_surf-{surf}_label-MPC-{surface_number:d}.func.gii".format(output=OPATH, bids_id=bids_id, hemi=hemi, surface_number=surface_number+1, surf=surf)
-    data = nb.load(thisname_gii).darrays[0].data
-    return data
-
-def get_feature_array(surf, Save=True):
-    BBl = np.vstack( [get_hemisphere(ii, 'L', surf) for ii in range(int(num_surf))] )
-    BBr = np.vstack( [get_hemisphere(ii, 'R', surf) for ii in range(int(num_surf))] )
-
-    # Concatenate hemispheres and flip so pial surface is at the top
-    BB = np.flipud(np.concatenate((BBl, BBr), axis = 1))
+def get_feature_array(surf, Save=True, n_threads=None):
+    # Intensity-profile cube of the surface space (both hemispheres), flip so pial surface is at the top
+    BB = np.flipud(load_profiles(OPATH, bids_id, surf, num_surf, n_threads=n_threads))
 
     if Save==True:
         fileName="{output}{bids_id}_surf-{surf}_desc-intensity_profiles.shape.gii".format(output=OPATH, bids_id=bids_id, surf=surf)
-        print('[INFO]... saving '+surf+' intensities as gifti array')
         save_gii(BB, fileName)
-    else:
-        return(BB)
+    return(BB)
 
-# Save the surfaces.array as a func.gii file
+def assemble_space(surf, n_threads):
+    # Profiles of one surface space: read, saved as gifti array, timed
+    t0 = time.time()
+    n_bytes = sum(os.path.getsize(f) for f in profile_files(OPATH, bids_id, surf, num_surf))
+    BB = get_feature_array(surf, n_threads=n_threads)
+    return BB, time.time() - t0, n_bytes
+
+# Save the surfaces.array as a func.gii file, the surface spaces are assembled in parallel
+# (decompression and gifti encoding release the GIL). The stacks used by the MPC are kept in memory
 surfaces=['fsnative', 'fsaverage5', 'fsLR-5k', 'fsLR-32k']
-for x in surfaces: get_feature_array(x)
+keep = ['fsLR-5k', 'fsLR-32k'] if args.vertex32k else ['fsLR-5k']
+n_workers = min(len(surfaces), n_threads_default())
+t0 = time.time()
+with ThreadPoolExecutor(max_workers=n_workers) as pool:
+    results = list(pool.map(lambda x: assemble_space(x, max(1, n_threads_default() // n_workers)), surfaces))
+for x, (_, t, n_bytes) in zip(surfaces, results):
+    print('[INFO]... {surf} intensities saved as gifti array: {t:.1f} s, {mb:.1f} MB read'.format(surf=x, t=t, mb=n_bytes / 1e6))
+stacks = {x: BB for x, (BB, _, _) in zip(surfaces, results) if x in keep}
+print('[INFO]... intensity profiles of {n} surface spaces assembled in {t:.1f} s'.format(n=len(surfaces), t=time.time() - t0))
+
+def report_problem_nodes(problemNodes, surf):
+    # Vertices whose intensity profiles are made up of NaNs (build_mpc / save_tiled_mpc)
+    if problemNodes:
+        print('[WARNING]... {surf} MPC: {n} problem nodes with NaN intensity profiles: {nodes}'.format(
+            surf=surf, n=len(problemNodes), nodes=' '.join(str(i) for i in problemNodes)))
 
 # Create a vertex-wise MPC from fsLR-5k
-surf_array_fsLR5k = get_feature_array('fsLR-5k', Save=False)
-(MPC_fsLR5k, I, problemNodes) = build_mpc(surf_array_fsLR5k)
+surf_array_fsLR5k = stacks['fsLR-5k']
+(MPC_fsLR5k, I, problemNodes) = build_mpc(surf_array_fsLR5k, dtype=np.float32)
+report_problem_nodes(problemNodes, 'fsLR-5k')
 fileName="{output}{bids_id}_surf-fsLR-5k_desc-MPC.shape.gii".format(output=OPATH, bids_id=bids_id)
 
 # Save it as shape GIFTI
 print('[INFO]... saving '+fileName)
-save_gii(MPC_fsLR5k, fileName)
-
-# cleanup - remove all feature-surf
+save_connectome(MPC_fsLR5k, fileName, meta={'surface': 'fsLR-5k'})
+
+# Diffusion-map gradients of the fsLR-5k MPC, from the matrix in memory
+if args.gradients > 0:
+    fileName="{output}{bids_id}_surf-fsLR-5k_desc-MPCgradients.shape.gii".format(output=OPATH, bids_id=bids_id)
+    print('[INFO]... saving '+fileName)
+    gradients, lambdas = mpc_gradients(MPC_fsLR5k, n_components=args.gradients)
+    save_gradients(gradients, lambdas, fileName, meta={'surface': 'fsLR-5k'})
+
+# Create a vertex-wise MPC from fsLR-32k: tiled and streamed to a packed upper triangle
+if args.vertex32k:
+    fileName="{output}{bids_id}_surf-fsLR-32k_desc-MPC.triu.npy".format(output=OPATH, bids_id=bids_id)
+    print('[INFO]... computing '+fileName)
+    problemNodes = save_tiled_mpc(stacks['fsLR-32k'], fileName, mem_gb=args.mem, n_threads=args.threads,
+                                  meta={'surface': 'fsLR-32k'})
+    report_problem_nodes(problemNodes, 'fsLR-32k')
+
+# cleanup - remove the per-depth feature-surf of the previous layout (the profile cubes are kept)
 tmp_files=sorted(glob.glob("{output}/*label-MPC-*.func.gii".format(output=OPATH)))
 for x in tmp_files: os.remove(x)
@@ -11,6 +11,10 @@
 # parc          1 x vertices vector with unique integrers correpsonding to
 #               node assignment. Leave empty, [], for a vertex-wise MPC
 #               Make sure that you provide different parcel # for each hemisphere
+# idxExclude    nodes excluded from the mean profile
+# dtype         data type of the residuals and of MPC (default float64)
+# out           preallocated nodes x nodes array (e.g. a memmap) that receives MPC
+# robust        median/MAD of the parcel outliers: 'select' (partition based, default) or 'sort'
 #
 # OUTPUT
 # MPC           microstructural profile covariance matrix
@@ -21,10 +25,21 @@
 
 # Import packages
 import numpy as np
-import scipy.special
-import scipy.stats
-
-def build_mpc(data, parc=None, idxExclude=None):
+from parcel_kernel import SegmentedParcellation
+from tiled_connectome import save_tiled_corrcoef, fisher_tile
+
+def residualize(I, I_M, dtype=np.float64):
+    # Residuals of all columns of I controlling for the mean profile I_M
+    # Closed form least squares of all the columns at once: y - ybar - slope * (x - xbar)
+    I_resid = np.array(I, dtype=dtype)
+    I_resid -= I_resid.mean(axis=0)
+    x = (I_M - I_M.mean()).astype(dtype)
+    slope = (x @ I_resid) / (x @ x)
+    for s in range(I_resid.shape[0]):
+        I_resid[s] -= x[s] * slope
+    return I_resid
+
+def build_mpc(data, parc=None, idxExclude=None, dtype=np.float64, out=None, robust='select'):
     # If no parcellation is provided, MPC will be computed vertexwise
     if parc is None:
         downsample = 0
@@ -34,33 +49,10 @@ def build_mpc(data, parc=None, idxExclude=None):
 
     # Parcellate input data according to parcellation scheme provided by user
     if downsample == 1:
-        uparcel = np.unique(parc)
-        I = np.zeros([data.shape[0], len(uparcel)])
-
-        # Parcellate data by averaging profiles within nodes
-        for (ii, _) in enumerate(uparcel):
-
-            # Get vertices within parcel
-            thisparcel = uparcel[ii]
-            tmpData = data[:, parc == thisparcel]
-            tmpData[:,np.mean(tmpData) == 0] = 0
-
-            # Define function to find outliers: Return index of values above three scaled median absolute deviations of input data
-            # https://www.mathworks.com/help/matlab/ref/isoutlier.html
-            def find_outliers(data_vector):
-                c = -1 / (np.sqrt(2) * scipy.special.erfcinv(3/2))
-                scaled_MAD = c * np.median(np.abs(data_vector - np.median(data_vector)))
-                is_outlier = np.greater(data_vector, (3 * scaled_MAD) + np.median(data_vector))
-                idx_outlier = [i for i, x in enumerate(is_outlier) if x]
-                return idx_outlier
-
-            # Find if there are any outliers in vertex-wise average profile within given parcel
-            idx = find_outliers(np.mean(tmpData, axis = 0))
-            if len(idx) > 0:
-                tmpData[:,idx] = np.nan
-
-            # Average profiles within parcels
-            I[:,ii] = np.nanmean(tmpData, axis = 1)
+        # Parcellate data by averaging profiles within nodes (vertices sorted by parcel once, see parcel_kernel.py)
+        segments = SegmentedParcellation(parc)
+        uparcel = segments.uparcel
+        I = segments.mpc_profiles(data, robust=robust)
 
         # Get matrix sizes
         szI = I.shape
@@ -69,7 +61,7 @@ def build_mpc(data, parc=None, idxExclude=None):
     else:
         I = data
         szI = data.shape
-        szZ = np.empty((data.shape[1], data.shape[1]))
+        szZ = [data.shape[1], data.shape[1]]
 
 
     # Build MPC
@@ -87,8 +79,8 @@ def build_mpc(data, parc=None, idxExclude=None):
         # Fill matrices with NaN for return
         I = np.zeros(szI)
         I[I == 0] = np.nan
-        MPC = np.zeros(szZ)
-        MPC[MPC == 0] = np.nan
+        MPC = np.empty(szZ, dtype=dtype) if out is None else out
+        MPC.fill(np.nan)
 
     else:
         problemNodes = 0
@@ -102,27 +94,43 @@ def build_mpc(data, parc=None, idxExclude=None):
         I_M = np.nanmean(I_mask, axis = 1)
 
         # Get residuals of all columns (controlling for mean)
-        I_resid = np.zeros(I.shape)
-        for c in range(I.shape[1]):
-            y = I[:,c]
-            x = I_M
-            slope, intercept, _, _, _ = scipy.stats.linregress(x,y)
-            y_pred = intercept + slope*x
-            I_resid[:,c] = y - y_pred
+        I_resid = residualize(I, I_M, dtype)
 
-        R = np.corrcoef(I_resid, rowvar=False)
+        # Correlation of the residuals (already centered), computed in place
+        with np.errstate(divide='ignore', invalid='ignore'):
+            I_resid /= np.sqrt(np.einsum('ij,ij->j', I_resid, I_resid))
+        MPC = np.empty(szZ, dtype=dtype) if out is None else out
+        np.matmul(I_resid.T, I_resid, out=MPC)
+        del I_resid
+        np.clip(MPC, -1, 1, out=MPC)
 
-        # Log transform
-        MPC = 0.5 * np.log( np.divide(1 + R, 1 - R) )
-        MPC[np.isnan(MPC)] = 0
-        MPC[np.isinf(MPC)] = 0
+        # Log transform: 0.5 * log((1 + R) / (1 - R))
+        np.arctanh(MPC, out=MPC)
+        np.nan_to_num(MPC, copy=False, nan=0, posinf=0, neginf=0)
 
         # CLEANUP: correct diagonal and round values to reduce file size
         # Replace all values in diagonal by zeros to account for floating point error
-        for i in range(0,MPC.shape[0]):
-                MPC[i,i] = 0
+        np.fill_diagonal(MPC, 0)
         # Replace lower triangle by zeros
-        MPC = np.triu(MPC)
+        for i in range(1, MPC.shape[0]):
+            MPC[i, :i] = 0
 
     # Output MPC, microstructural profiles, and problem nodes
     return (MPC, I, problemNodes)
+
+
+def save_tiled_mpc(data, fileName, dtype=np.float32, mem_gb=4, n_threads=None, meta=None):
+    # Vertex-wise MPC streamed, tile by tile, to a packed upper triangle (<name>.triu.npy)
+    # For surfaces where the dense MPC does not fit in memory (e.g. fsLR-32k).
+    # Same values as build_mpc(data) without parcellation, the NaN check returns the problem nodes.
+    if np.isnan(np.sum(data)):
+        problemNodes = [i for i, x in enumerate(np.isnan(data[1,:])) if x]
+        print("")
+        print("---------------------------------------------------------------------------------")
+        print("There seems to be an issue with the input data. The tiled MPC was not computed!")
+        print("---------------------------------------------------------------------------------")
+        print("")
+        return problemNodes
+    I_resid = residualize(data, np.nanmean(data, axis = 1), dtype)
+    save_tiled_corrcoef(I_resid, fileName, dtype=dtype, mem_gb=mem_gb, n_threads=n_threads, meta=meta, transform=fisher_tile)
+    return 0
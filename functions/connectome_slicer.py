@@ -27,20 +27,9 @@ Created on June 2023 (the year of light)
 
 import argparse
 import pandas as pd
-import nibabel as nib
 import numpy as np
 import os
-
-# Function save as gifti
-def save_gii(data_array, file_name):
-    # Initialize gifti: NIFTI_INTENT_SHAPE - 2005, FLOAT32 - 16
-    gifti_data = nib.gifti.GiftiDataArray(data=data_array, intent=2005, datatype=16)
-
-    # this is the GiftiImage class
-    gifti_img = nib.gifti.GiftiImage(meta=None, darrays=[gifti_data])
-
-    # Save the new GIFTI file
-    nib.save(img=gifti_img, filename=file_name)
+from packed_connectome import save_connectome
 
 # Argument parsing
 parser = argparse.ArgumentParser(description="micapipe connectome slicer")
@@ -63,7 +52,7 @@ print("INFO.... Connectome dimensions: {} x {}".format(M.shape[0], M.shape[1]))
 if "fsLR-5k" in args.conn:
     print("Connectome is 'fsLR-5k'. Saving as GIFTI without slicing.")
     output_file = args.conn.replace("txt", "shape.gii")
-    save_gii(M, output_file)
+    save_connectome(M, output_file)
     print("GIFTI file saved as:", output_file)
 else:
     if M.shape[0] == len(indx):
@@ -74,7 +63,7 @@ else:
         M = M[np.ix_(indx, indx)]
         # Save the GIFTI data to a file
         output_file = args.conn.replace("txt", "shape.gii")
-        save_gii(M, output_file)
+        save_connectome(M, output_file)
         print("GIFTI file saved as:", output_file)
 
 # Remove the txt file
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Diffusion-map gradients of a connectome, computed in memory from a sparse affinity.
+
+The affinity keeps, for every node, the strongest (positive) values of its row
+(sparsity=0.9 keeps the top 10%), and is symmetrized as (T + T') / 2. The
+connectome is read in blocks of rows, so no dense copy of the matrix is made.
+The leading eigenvectors of the normalized affinity are found with a
+truncated sparse eigensolver (ARPACK, or LOBPCG), as in the diffusion map
+embedding of Coifman & Lafon (2006) with alpha=0.5 and multi-scale
+(diffusion_time=0) eigenvalues.
+
+The affinity kernel is the thresholded connectome itself, brainspace's
+GradientMaps default ('normalized_angle') needs a dense node x node kernel
+and is not used. Nodes outside the largest connected component of the
+affinity (e.g. excluded nodes) get NaN gradients.
+
+    Functions
+    ---------
+    sparse_affinity : row-wise thresholded symmetric affinity (scipy.sparse)
+    diffusion_map   : gradients and eigenvalues of an affinity
+    mpc_gradients   : gradients of a build_mpc connectome (upper triangle)
+    save_gradients  : writes the gradients (components x nodes) as a shape.gii
+"""
+
+import json
+import numpy as np
+import nibabel as nb
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import eigsh, lobpcg
+
+
+def sparse_affinity(M, sparsity=0.9, triu=True, exclude=None, chunk=1024):
+    """ Sparse affinity of the strongest positive values of each row.
+
+    Parameters
+    ----------
+    M : array (nodes x nodes), connectome (can be a memmap)
+    sparsity : float, fraction of the values of each row set to zero
+    triu : bool, M only holds the upper triangle (build_mpc), the rows are completed with the columns
+    exclude : array of int, nodes left out of the affinity (isolated)
+    chunk : int, number of rows processed at once
+
+    Return
+    ------
+    A : scipy.sparse.csr_matrix (nodes x nodes), symmetric
+    """
+    N = M.shape[0]
+    k = max(1, int(np.ceil(N * (1 - sparsity))))
+    excluded = np.zeros(N, dtype=bool)
+    if exclude is not None:
+        excluded[np.asarray(exclude, dtype=int)] = True
+    rows, cols, vals = [], [], []
+    for a in range(0, N, chunk):
+        b = min(N, a + chunk)
+        block = np.array(M[a:b], dtype=np.float64)
+        if triu:
+            block += M[:, a:b].T
+        block[:, excluded] = 0
+        block[excluded[a:b]] = 0
+        np.nan_to_num(block, copy=False, nan=0, posinf=0, neginf=0)
+        idx = np.argpartition(block, N - k, axis=1)[:, N - k:]
+        v = np.take_along_axis(block, idx, axis=1)
+        keep = v > 0
+        rows.append(np.broadcast_to(np.arange(a, b)[:, None], idx.shape)[keep])
+        cols.append(idx[keep])
+        vals.append(v[keep])
+    T = sparse.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=(N, N))
+    return ((T + T.T) / 2).tocsr()
+
+
+def diffusion_map(A, n_components=10, alpha=0.5, diffusion_time=0, solver='arpack', random_state=0):
+    """ Diffusion map embedding of a symmetric sparse affinity.
+
+    Parameters
+    ----------
+    A : scipy.sparse matrix (nodes x nodes), symmetric and non-negative
+    n_components : int, number of gradients
+    alpha : float, anisotropic diffusion parameter (0.5: Fokker-Planck)
+    diffusion_time : float, <= 0 for multi-scale eigenvalues lambda / (1 - lambda)
+    solver : str, 'arpack' (scipy eigsh) or 'lobpcg'
+    random_state : int, seed of the starting vectors
+
+    Return
+    ------
+    gradients : array (nodes x components), NaN outside the largest connected component
+    lambdas : array (components), eigenvalues (scaled by the diffusion time)
+    """
+    A = sparse.csr_matrix(A, dtype=np.float64)
+    N = A.shape[0]
+    # Largest connected component, isolated nodes are their own component
+    _, labels = connected_components(A, directed=False)
+    mask = labels == np.argmax(np.bincount(labels))
+    A = A[mask][:, mask]
+    n = A.shape[0]
+    n_components = min(n_components, n - 2)
+    if n_components < 1:
+        raise ValueError('The affinity has only {} connected nodes'.format(n))
+
+    if alpha > 0:
+        d = sparse.diags(np.asarray(A.sum(axis=1)).ravel() ** -alpha)
+        A = d @ A @ d
+    dm12 = 1 / np.sqrt(np.asarray(A.sum(axis=1)).ravel())
+    L = sparse.diags(dm12) @ A @ sparse.diags(dm12)
+
+    # Leading eigenpairs of the symmetric normalized affinity (the first one is trivial)
+    rng = np.random.default_rng(random_state)
+    k = n_components + 1
+    if solver == 'arpack':
+        lambdas, vectors = eigsh(L, k=k, which='LA', v0=rng.uniform(-1, 1, n))
+    elif solver == 'lobpcg':
+        lambdas, vectors = lobpcg(L, rng.normal(size=(n, k)), largest=True, tol=1e-8, maxiter=1000)
+    else:
+        raise ValueError("Unknown solver '{}', use 'arpack' or 'lobpcg'".format(solver))
+    order = np.argsort(lambdas)[::-1]
+    lambdas, vectors = lambdas[order], vectors[:, order]
+
+    psi = vectors * dm12[:, None]
+    psi = psi[:, 1:] / psi[:, [0]]
+    lambdas = lambdas[1:]
+    if diffusion_time <= 0:
+        lambdas = lambdas / (1 - lambdas)
+    else:
+        lambdas = lambdas ** diffusion_time
+    # Deterministic sign: largest absolute value of each gradient is positive
+    psi *= np.sign(psi[np.abs(psi).argmax(axis=0), np.arange(psi.shape[1])])
+
+    gradients = np.full((N, n_components), np.nan)
+    gradients[mask] = psi * lambdas
+    return gradients, lambdas
+
+
+def mpc_gradients(MPC, n_components=10, sparsity=0.9, exclude=None, solver='arpack'):
+    """ Diffusion-map gradients of a build_mpc connectome (upper triangle, zero lower triangle).
+
+    Return
+    ------
+    gradients : array (nodes x components)
+    lambdas : array (components)
+    """
+    A = sparse_affinity(MPC, sparsity=sparsity, triu=True, exclude=exclude)
+    return diffusion_map(A, n_components=n_components, solver=solver)
+
+
+def save_gradients(gradients, lambdas, fileName, meta=None):
+    """ Saves the gradients as a (components x nodes) shape.gii, the eigenvalues are in the metadata """
+    meta = dict(meta or {}, lambdas=[float(x) for x in lambdas])
+    gifti_data = nb.gifti.GiftiDataArray(data=np.ascontiguousarray(gradients.T, dtype=np.float32), intent=2005, datatype=16)
+    gifti_meta = nb.gifti.GiftiMetaData({key: json.dumps(value) for key, value in meta.items()})
+    nb.save(img=nb.gifti.GiftiImage(meta=gifti_meta, darrays=[gifti_data]), filename=fileName)
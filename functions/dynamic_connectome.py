@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Sliding-window dynamic functional connectomes.
+
+Recomputing np.corrcoef on every window costs O(windows * window * N^2).
+Here the sums and cross-products of the window are updated incrementally:
+moving the window by `step` timepoints removes the `step` oldest frames and
+adds the `step` newest ones (rank-1 updates for step=1, a single GEMM for
+larger steps), so each window costs O(step * N^2) instead of O(window * N^2).
+The running sums are recomputed exactly every `refresh` windows to bound the
+accumulation of rounding errors.
+
+The windows are saved as a stack of packed upper triangles
+(<name>.triu.npy: windows x N*(N+1)/2, see packed_connectome.py).
+"""
+
+import numpy as np
+from packed_connectome import create_packed
+
+
+def n_windows(n_time, window, step=1):
+    """ Number of complete windows of length `window` every `step` timepoints """
+    return 0 if n_time < window else (n_time - window) // step + 1
+
+
+def corr_from_sums(S, C, n):
+    """ Correlation matrix from the sum S and the cross-products C of n timepoints """
+    cov = C - np.outer(S, S) / n
+    d = np.sqrt(np.diag(cov))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        R = cov / np.outer(d, d)
+    np.clip(R, -1, 1, out=R)
+    return R
+
+
+def sliding_corrcoef(ts, window, step=1, refresh=100):
+    """ Correlation matrices of the sliding windows of ts.
+
+    Parameters
+    ----------
+    ts : array (timepoints x N)
+    window : int, window length (timepoints)
+    step : int, timepoints between the start of two windows
+    refresh : int, the running sums are recomputed every `refresh` windows
+
+    Return
+    ------
+    generator of (start, R), R is the (N x N) np.corrcoef of ts[start:start+window]
+    """
+    n_time = ts.shape[0]
+    if window < 2 or window > n_time:
+        raise ValueError('Window length must be between 2 and {} timepoints, not {}'.format(n_time, window))
+    if step < 1:
+        raise ValueError('Window step must be a positive number of timepoints')
+    # Centered data: smaller running sums and less cancellation in C - S S' / window
+    X = np.asarray(ts, dtype=np.float64)
+    X = X - X.mean(axis=0)
+    for k in range(n_windows(n_time, window, step)):
+        start = k * step
+        if k % refresh == 0 or step >= window:
+            S = X[start:start + window].sum(axis=0)
+            C = X[start:start + window].T @ X[start:start + window]
+        else:
+            old = X[start - step:start]
+            new = X[start - step + window:start + window]
+            S += new.sum(axis=0) - old.sum(axis=0)
+            C += new.T @ new
+            C -= old.T @ old
+        yield start, corr_from_sums(S, C, window)
+
+
+def save_dynamic_fc(ts, fileName, window, step=1, exclude=None, dtype=np.float32, meta=None):
+    """ Saves the sliding-window FC of ts as a packed stack (windows x upper triangle).
+
+    Parameters
+    ----------
+    ts : array (timepoints x N), cleaned timeseries
+    fileName : str, output <name>.triu.npy (or .shape.gii)
+    window, step : int, window length and step (timepoints)
+    exclude : list of int, nodes whose rows and columns are set to zero
+    """
+    N = ts.shape[1]
+    header = {'window': int(window), 'step': int(step), 'n_timepoints': int(ts.shape[0])}
+    header.update(meta or {})
+    out = create_packed(fileName, N, dtype=dtype, meta=header, n_frames=n_windows(ts.shape[0], window, step))
+    iu = np.triu_indices(N)
+    for k, (_, R) in enumerate(sliding_corrcoef(ts, window, step)):
+        if exclude:
+            R[:, exclude] = 0
+            R[exclude, :] = 0
+        out[k] = R[iu]
+    out.flush()
+    del out
@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+micapipe Functional Connectome library and multi-subject driver.
+
+The stages of 03_FC.py (confound regression, parcellation, FC and tSNR) as
+importable functions. `run_subject` processes one subject exactly like
+03_FC.py, and `run_batch` processes a list of subjects in a long-lived
+process pool: the imports and the shared state (parcellation operators)
+are loaded once per worker instead of once per subject.
+
+    Usage (driver)
+    -----
+    func_connectome.py -jobs <jobs.csv> [-workers N] [-threads N]
+
+    jobs.csv has one row per subject and the 03_FC.py positional arguments as
+    columns: subject,funcDir,labelDir,parcDir,volmDir,performNSR,performGSR,func_lab,noFC,gsr
+"""
+
+import os
+import csv
+import json
+import glob
+import argparse
+import functools
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import nibabel as nib
+from nuisance_regression import load_design, censored_frames, ConfoundProjector
+from parcel_operator import load_operator, nan_split
+from gifti_io import load_func_gii, iter_func_gii
+from tiled_connectome import save_tiled_corrcoef, threadpool_limits
+from packed_connectome import save_connectome
+from dynamic_connectome import save_dynamic_fc
+from pooled_connectome import update_pooled_fc
+
+JOB_COLUMNS = ['subject', 'funcDir', 'labelDir', 'parcDir', 'volmDir', 'performNSR', 'performGSR', 'func_lab', 'noFC', 'gsr']
+
+
+class FCInputError(Exception):
+    """ Missing or empty inputs of the functional connectome """
+
+
+# Function save as gifti
+def save_gii(data_array, file_name, meta=None):
+    # Initialize gifti: NIFTI_INTENT_SHAPE - 2005, FLOAT32 - 16
+    gifti_data = nib.gifti.GiftiDataArray(data=data_array, intent=2005, datatype=16)
+
+    # this is the GiftiImage class, meta values are saved as json strings
+    if meta is not None:
+        meta = nib.gifti.GiftiMetaData({key: json.dumps(value) for key, value in meta.items()})
+    gifti_img = nib.gifti.GiftiImage(meta=meta, darrays=[gifti_data])
+
+    # Save the new GIFTI file
+    nib.save(img=gifti_img, filename=file_name)
+
+
+@functools.lru_cache(maxsize=None)
+def get_operator(parcDir, parcellation):
+    """ Parcellation operator, loaded once per process """
+    return load_operator(parcDir, parcellation)
+
+
+def missing_elements(roiList):
+    start, end = 0, 33
+    return sorted(set(range(start, end + 1)).difference(roiList))
+
+
+def load_sctx_cereb(funcDir, subject, func_lab):
+    """ Loads the subcortical and cerebellar timeseries.
+
+    Return
+    ------
+    sctx_cereb : array (timepoints x (n_sctx + 34))
+    n_sctx : int, number of subcortical nodes
+    exclude_labels : list, cerebellar nodes lost in the co-registration ([nan] if none)
+    """
+    # Subcortex
+    sctx = np.loadtxt(funcDir+'/volumetric/' + subject + func_lab + '_timeseries_subcortical.txt')
+    if not sctx.shape:
+        raise FCInputError('Uh oh, your subcortical timeseries file is empty; exiting. Bye-bye')
+    n_sctx = sctx.shape[1]
+
+    # Cerebellum
+    # A little hacky because the co-registration to fMRI space make some cerebellar ROIs disappear
+    # Missing label indices are replaced by zeros in timeseries and FC matrix
+    cereb_tmp = np.loadtxt(funcDir+'/volumetric/' + subject + func_lab + '_timeseries_cerebellum.txt')
+    with open(funcDir+'/volumetric/' + subject + func_lab + '_cerebellum_roi_stats.txt', "rt") as f:
+        cerebLabels = f.read()
+    s1 = cerebLabels.find("nii.gz")
+    startROIs = s1 + len("nii.gz") + 6
+    values = cerebLabels[startROIs:].split("\t")
+    roiLabels = values[0::2]
+
+    if len(roiLabels) == 34: # no labels disappeared in the co-registration
+        print('All cerebellar labels found in parcellation!')
+        cereb = cereb_tmp
+        exclude_labels = [np.nan]
+    else:
+        print('Some cerebellar ROIs were lost in co-registration to fMRI space')
+        cereb = np.zeros((cereb_tmp.shape[0], 34), dtype=np.int8)
+        roiLabelsInt = np.zeros((1,len(roiLabels)), dtype=np.int8)
+        for (ii, _) in enumerate(roiLabels):
+            roiLabelsInt[0,ii] = int(float(roiLabels[ii]))
+        roiLabelsInt = roiLabelsInt - 1
+        for (ii, _) in enumerate(roiLabels):
+            cereb[:,roiLabelsInt[0,ii]] = cereb_tmp[:,ii]
+        exclude_labels = missing_elements(roiLabelsInt[0])
+        print('Matrix entries for following ROIs will be zero: ', exclude_labels)
+
+    return np.append(sctx, cereb, axis=1), n_sctx, exclude_labels
+
+
+def find_confounds(funcDir, func_lab):
+    """ Paths of the confound files (empty string if missing) """
+    return {'x_spike': " ".join(glob.glob(funcDir+'/volumetric/'+'*spikeRegressors_FD.1D')),
+            'x_dof': " ".join(glob.glob(funcDir+'/volumetric/*'+func_lab+'.1D')),
+            'x_fd': " ".join(glob.glob(funcDir+'/volumetric/'+'*metric_FD*')),
+            'x_csf': " ".join(glob.glob(funcDir+'/volumetric/'+'*CSF*')),
+            'x_wm': " ".join(glob.glob(funcDir+'/volumetric/'+'*WM*')),
+            'x_gs': " ".join(glob.glob(funcDir+'/volumetric/'+'*global*'))}
+
+
+def build_projector(confounds, performNSR, performGSR, gsr, censor=False):
+    """ Builds the confound model once: the same projection is applied to every data block.
+
+    With censor, the frames flagged in spikeRegressors_FD are removed instead of regressed.
+    """
+    mdl, model = load_design(confounds['x_spike'], confounds['x_dof'], confounds['x_wm'],
+                             confounds['x_csf'], confounds['x_gs'], performNSR, performGSR, gsr, censor=censor)
+    print('')
+    print('Confound model : ' + model)
+    censored = censored_frames(confounds['x_spike']) if censor else None
+    if censor:
+        print('Censored frames: {} of {}'.format(len(censored), mdl.shape[0]))
+    return ConfoundProjector(mdl, censored=censored)
+
+
+def get_regressed_data(projector, Data, Data_name):
+    """ Nuisance signal regression: spikes and (optional) WM/CSF:
+        Applies the shared confound projection to Data (in place, float32).
+
+    Parameters
+    ----------
+    projector : ConfoundProjector
+    Data : array (timepoints x N)
+    Data_name : str
+
+    Return
+    ------
+    Data_corr : array of data corrected
+    """
+    if projector.rank > 0:
+        print('apply regression: ' + Data_name)
+    return projector.apply(Data)
+
+
+def list_parcellations(volmDir):
+    """ Names of the processed cortical parcellations """
+    # Read the processed parcellations
+    parcellationList = glob.glob(volmDir + "/*atlas*.nii.gz")
+
+    # Slice the file names and remove nii*
+    parcellationList=[sub.split('atlas-')[1].split('.nii')[0] for sub in parcellationList]
+
+    # Remove cerebellum and subcortical strings
+    parcellationList.remove('subcortical')
+    parcellationList.remove('cerebellum')
+    return parcellationList
+
+
+def excluded_nodes(n_sctx, exclude_labels):
+    """ Indices of the cerebellar nodes lost in the co-registration (rows/columns set to zero) """
+    if np.isnan(exclude_labels[0]):
+        return []
+    return [i + n_sctx for i in exclude_labels]
+
+
+def parcel_fc(ts, n_sctx, exclude_labels):
+    """ Upper triangle of the FC of the subcortical, cerebellar and cortical (parcellated) timeseries """
+    ts_r = np.corrcoef(np.transpose(ts))
+    for i in excluded_nodes(n_sctx, exclude_labels):
+        ts_r[:, i] = 0
+        ts_r[i, :] = 0
+    return np.triu(ts_r)
+
+
+def atlas_fc(data_corr, sctx_cereb_corr, n_sctx, exclude_labels, parcDir, parcellationList, out_prefix,
+             dfc_window=None, dfc_step=1, pool_prefix=None, run=None, run_meta=None):
+    """ Parcellates the cleaned fsLR-32k timeseries and saves one FC per atlas.
+
+    With dfc_window, also saves the sliding-window dynamic FC (packed stack <...>_desc-dFC.triu.npy).
+    With pool_prefix, adds the run to the pooled FC of all the runs of the subject (<pool_prefix>_..._desc-FCpooled).
+    run_meta (e.g. the censored frames) is added to the metadata of the FC of this run.
+    """
+    # NaNs are handled once for all parcellations (zero-filled data + mask of valid values)
+    data_parc, valid = nan_split(data_corr)
+    for parcellation in parcellationList:
+        # Parcellate cortical timeseries: cached sparse averaging operator
+        thisparc = get_operator(parcDir, parcellation)
+        ts = np.append(sctx_cereb_corr, thisparc(data_parc, valid), axis=1)
+        meta = {'atlas': parcellation, 'n_subcortical': n_sctx, 'n_cerebellar': 34,
+                'cortical_labels': thisparc.uparcel.tolist()}
+        save_connectome(parcel_fc(ts, n_sctx, exclude_labels),
+                        out_prefix+'_surf-fsLR-32k_atlas-'+parcellation+'_desc-FC.shape.gii', meta=dict(meta, **(run_meta or {})))
+        if dfc_window:
+            print('[INFO]... Dynamic FC: '+parcellation)
+            save_dynamic_fc(ts, out_prefix+'_surf-fsLR-32k_atlas-'+parcellation+'_desc-dFC.triu.npy',
+                            dfc_window, dfc_step, exclude=excluded_nodes(n_sctx, exclude_labels),
+                            meta=dict(meta, **(run_meta or {})))
+        if pool_prefix:
+            pool_name = pool_prefix+'_surf-fsLR-32k_atlas-'+parcellation+'_desc-FCpooled'
+            # The pooled FC is saved under the lock of the state file
+            _, runs = update_pooled_fc(pool_name+'.state.npz', run, ts, exclude=excluded_nodes(n_sctx, exclude_labels),
+                                       writer=lambda R, runs: save_connectome(R, pool_name+'.shape.gii', meta=dict(meta, runs=runs)))
+            print('[INFO]... Pooled FC: '+parcellation+', runs: '+' '.join(runs))
+
+
+def vertex_fc(ts):
+    """ Upper triangle of the vertex-wise FC """
+    return np.triu(np.corrcoef(np.transpose(ts)))
+
+
+def plot_framewise_displacement(x_fd, fileName):
+    """ mean framewise displacement + save plot """
+    import matplotlib.pyplot as plt
+    fd = np.loadtxt(x_fd)
+    title = 'mean FD: ' + str(np.mean(fd))
+    fig, ax = plt.subplots(figsize=(16, 6))
+    plt.plot(fd, color="#2171b5")
+    plt.title(title, fontsize=16)
+    ax.set(xlabel='')
+    ax.spines['top'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    plt.savefig(fileName, dpi=300)
+    plt.close(fig)
+
+
+def streaming_tsnr(lh_file, rh_file):
+    """ Single pass tSNR, global signal and DVARS of the fsnative timeseries.
+
+    The timepoints of both hemispheres are read one at a time and accumulated
+    with Welford's running mean and variance, memory is O(vertices) whatever
+    the length of the run.
+
+    Return
+    ------
+    tSNR : array (vertices x 1), mean / std (population std, as np.std)
+    gs : array (timepoints,), global signal (mean over vertices)
+    dvars : array (timepoints,), RMS over vertices of the temporal derivative (0 at the first timepoint)
+    """
+    n = 0
+    mean = M2 = previous = None
+    gs, dvars = [], []
+    for lh, rh in zip(iter_func_gii(lh_file), iter_func_gii(rh_file)):
+        x = np.concatenate((lh, rh))
+        if mean is None:
+            mean, M2 = np.zeros_like(x), np.zeros_like(x)
+        n += 1
+        delta = x - mean
+        mean += delta / n
+        M2 += delta * (x - mean)
+        gs.append(np.mean(x))
+        dvars.append(0 if previous is None else np.sqrt(np.mean(np.square(x - previous))))
+        previous = x
+    if n == 0:
+        raise FCInputError('Empty fsnative timeseries: ' + lh_file)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tSNR = np.divide(mean, np.sqrt(M2 / n))
+    return np.expand_dims(tSNR, axis=1), np.asarray(gs), np.asarray(dvars)
+
+
+def run_subject(subject, funcDir, labelDir, parcDir, volmDir, performNSR, performGSR, func_lab, noFC, gsr,
+                fc_vertex32k=False, fc_mem=8, fc_dtype='float32', threads=None, dfc_window=None, dfc_step=1, fc_pool=False, censor=False):
+    """ Functional connectome of one subject (same outputs as 03_FC.py).
+
+    Parameters are the 03_FC.py arguments. Raises FCInputError when inputs are missing.
+    With fc_pool, the run (func_lab) is added to the pooled FC saved in the parent of funcDir.
+    With censor, the spike frames are removed from the clean timeseries and listed in the
+    'censored_frames' metadata of the outputs, with the number of frames of the run ('n_timepoints').
+    """
+    # check if surface directory exist
+    if not os.path.isdir(funcDir+"/surf/"):
+        raise FCInputError('No surface directory. Run the module -proc_freesurfer first!')
+    print('')
+    print('-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-')
+    print('surf directory found; lets get the party started!')
+    print('-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-')
+    print('')
+    out_prefix = funcDir+'/surf/'+subject
+
+    # Subcortical and cerebellar timeseries
+    sctx_cereb, n_sctx, exclude_labels = load_sctx_cereb(funcDir, subject, func_lab)
+
+    # Confounds: one model for all the data blocks
+    confounds = find_confounds(funcDir, func_lab)
+    projector = build_projector(confounds, performNSR, performGSR, gsr, censor=censor)
+    # Censoring metadata of every output (GIFTI metadata and .triu.json sidecar)
+    run_meta = {'censored_frames': projector.censored.tolist(), 'n_timepoints': projector.n_timepoints} if censor else {}
+    sctx_cereb_corr = get_regressed_data(projector, sctx_cereb, 'sctx_cereb')
+
+    # ------------------------------------------
+    #     C O R T E X  processing
+    # ------------------------------------------
+    # Find and load surface-registered cortical timeseries (float32, both hemispheres in one buffer)
+    x_lh = glob.glob(funcDir+'/surf/'+'*_hemi-L_surf-fsLR-32k.func.gii')
+    x_rh = glob.glob(funcDir+'/surf/'+'*_hemi-R_surf-fsLR-32k.func.gii')
+    data_corr = get_regressed_data(projector, load_func_gii([x_lh[0], x_rh[0]]), 'fsLR-32k')
+
+    # save spike regressed and concatenanted timeseries (subcortex, cerebellum, cortex)
+    save_gii(data_corr, out_prefix+'_surf-fsLR-32k_desc-timeseries_clean.shape.gii', meta=run_meta or None)
+
+    # Vertex-wise fsLR-32k FC: tiled correlation streamed to a packed upper triangle
+    if fc_vertex32k:
+        save_tiled_corrcoef(data_corr, out_prefix+'_surf-fsLR-32k_desc-FC.triu.npy',
+                            dtype=fc_dtype, mem_gb=fc_mem, n_threads=threads, meta=dict(run_meta, surface='fsLR-32k'))
+
+    if noFC!="TRUE":
+        atlas_fc(data_corr, sctx_cereb_corr, n_sctx, exclude_labels, parcDir, list_parcellations(volmDir), out_prefix,
+                 dfc_window=dfc_window, dfc_step=dfc_step,
+                 pool_prefix=os.path.join(os.path.dirname(os.path.normpath(funcDir)), subject) if fc_pool else None,
+                 run=func_lab, run_meta=run_meta)
+    else:
+        print('')
+        print('...... no FC was selected, will skipp the functional connectome generation')
+    del data_corr
+
+    # ------------------------------------------
+    # fsLR-5k FC
+    # ------------------------------------------
+    x_lh = glob.glob(funcDir+'/surf/'+'*_hemi-L_surf-fsLR-5k.func.gii')
+    x_rh = glob.glob(funcDir+'/surf/'+'*_hemi-R_surf-fsLR-5k.func.gii')
+    ts = get_regressed_data(projector, load_func_gii([x_lh[0], x_rh[0]]), 'fsLR-5k')
+    save_connectome(vertex_fc(ts), out_prefix+'_surf-fsLR-5k_desc-FC.shape.gii', meta=dict(run_meta, surface='fsLR-5k'))
+    del ts
+
+    # ------------------------------------------
+    # Additional QC
+    # ------------------------------------------
+    print('')
+    print('-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+')
+    print('Calculating tSNR and framewise displacement')
+    print('-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+')
+    plot_framewise_displacement(confounds['x_fd'], funcDir+'/volumetric/' + subject + func_lab + '_framewiseDisplacement.png')
+
+    # tSNR
+    lh_nat_noHP = " ".join(glob.glob(funcDir+'/surf/'+'*hemi-L_surf-fsnative_NoHP.func.gii'))
+    rh_nat_noHP = " ".join(glob.glob(funcDir+'/surf/'+'*hemi-R_surf-fsnative_NoHP.func.gii'))
+    tSNR, gs, dvars = streaming_tsnr(lh_nat_noHP, rh_nat_noHP)
+    save_gii(tSNR, funcDir+'/volumetric/'+subject+func_lab+'_tSNR.shape.gii')
+    # Global signal and DVARS of the fsnative timeseries (computed in the same pass)
+    np.savetxt(funcDir+'/volumetric/'+subject+func_lab+'_surf-fsnative_desc-GS-DVARS.txt',
+               np.column_stack((gs, dvars)), header='GS DVARS', fmt='%.6f')
+    print('')
+    print('-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+')
+    print('func regression and FC ran successfully')
+    print('-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+')
+
+
+# ------------------------------------------
+# Multi-subject driver
+# ------------------------------------------
+_worker_limits = None
+
+
+def _init_worker(parcDirs, threads):
+    """ Loads the shared state once per worker """
+    global _worker_limits
+    if threads and threadpool_limits is not None:
+        _worker_limits = threadpool_limits(limits=threads, user_api='blas')
+    for parcDir in parcDirs:
+        for parcPath in glob.glob(os.path.join(parcDir, '*_conte69.csv')):
+            get_operator(parcDir, os.path.basename(parcPath).replace('_conte69.csv', ''))
+
+
+def _run_job(job, options):
+    try:
+        run_subject(*[job[col] for col in JOB_COLUMNS], **options)
+        return job['subject'], None
+    except Exception:
+        return job['subject'], traceback.format_exc()
+
+
+def read_jobs(fileName):
+    """ Reads the jobs csv (one subject per row, 03_FC.py arguments as columns) """
+    with open(fileName, newline='') as f:
+        jobs = list(csv.DictReader(f))
+    for job in jobs:
+        missing = [col for col in JOB_COLUMNS if col not in job]
+        if missing:
+            raise ValueError('jobs file is missing the columns: ' + ', '.join(missing))
+        job['gsr'] = job['gsr'] or ''
+    return jobs
+
+
+def run_batch(jobs, n_workers=1, threads=None, **options):
+    """ Runs run_subject for each job in a pool of long-lived worker processes.
+
+    Parameters
+    ----------
+    jobs : list of dict with the JOB_COLUMNS keys
+    n_workers : int, number of worker processes
+    threads : int, BLAS threads per worker
+    options : keyword arguments of run_subject (fc_vertex32k, fc_mem, fc_dtype, dfc_window, dfc_step, fc_pool, censor)
+
+    Return
+    ------
+    failed : dict {subject: traceback} of the subjects that failed
+    """
+    parcDirs = sorted(set(job['parcDir'] for job in jobs))
+    options['threads'] = threads
+    failed = {}
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(parcDirs, threads)) as pool:
+        futures = [pool.submit(_run_job, job, options) for job in jobs]
+        for n, future in enumerate(as_completed(futures)):
+            subject, error = future.result()
+            if error is None:
+                print('[INFO]... {n}/{N} {subject} completed'.format(n=n+1, N=len(jobs), subject=subject))
+            else:
+                failed[subject] = error
+                print('[ERROR].. {n}/{N} {subject} failed\n{error}'.format(n=n+1, N=len(jobs), subject=subject, error=error))
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='micapipe functional connectome, multi-subject driver')
+    parser.add_argument('-jobs', required=True, help='csv file with one subject per row and the 03_FC.py arguments as columns')
+    parser.add_argument('-workers', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('-threads', type=int, default=None, help='Number of BLAS threads per worker')
+    parser.add_argument('-fc_vertex32k', default=False, action='store_true',
+                        help='Compute the vertex-wise fsLR-32k functional connectome (tiled, out-of-core)')
+    parser.add_argument('-fc_mem', type=float, default=8, help='Memory ceiling in GB of each tile of the vertex-wise FC')
+    parser.add_argument('-fc_dtype', default='float32', choices=['float32', 'float16'],
+                        help='Data type of the vertex-wise fsLR-32k FC')
+    parser.add_argument('-dfc_window', type=int, default=None,
+                        help='Window length (timepoints) of the sliding-window dynamic FC of each parcellation')
+    parser.add_argument('-dfc_step', type=int, default=1, help='Step (timepoints) between two windows of the dynamic FC')
+    parser.add_argument('-fc_pool', default=False, action='store_true',
+                        help='Add each run to the pooled FC of all the runs of its subject')
+    parser.add_argument('-censor', default=False, action='store_true',
+                        help='Remove the spike frames from the data and the design instead of regressing one column per spike')
+    args = parser.parse_args()
+    failed = run_batch(read_jobs(args.jobs), n_workers=args.workers, threads=args.threads,
+                       fc_vertex32k=args.fc_vertex32k, fc_mem=args.fc_mem, fc_dtype=args.fc_dtype,
+                       dfc_window=args.dfc_window, dfc_step=args.dfc_step, fc_pool=args.fc_pool,
+                       censor=args.censor)
+    if failed:
+        raise SystemExit('{} subjects failed: {}'.format(len(failed), ', '.join(failed)))
@@ -4,6 +4,7 @@
 """
 Compute geodesic distance matrix vertex-wise or parcel-wise (centroids) of native surface.
 For parcel-wise GD, centroid vertices will be selected for each parcel and distance will only be propagated from these points.
+The distances are computed in memory (geodesic_engine.py), in parallel worker processes (OMP_NUM_THREADS).
 
     Parameters
     ----------
@@ -26,10 +27,16 @@ For parcel-wise GD, centroid vertices will be selected for each parcel and dista
     parcel_wise  : optional
         Calculate distance parcel-wise. Default is vertex-wise.
 
+    method : str, optional
+        'exact' geodesic distances (pygeodesic, default) or 'heat' method approximation
+        (prefactorized cotangent Laplacian, see heat_geodesic.py).
+
     Returns
     -------
     GD  : numpy.ndarray file
-        Geodesic distance matrix (.shape.gii) { (Vertex x Vertex) | (nParcel x nParcel) }
+        Parcel-wise: geodesic distance matrix (nParcel x nParcel) <outPath>.shape.gii
+        Vertex-wise: one float32 packed upper triangle (Vertex x Vertex) per hemisphere,
+        <outPath>_hemi-{L,R}.triu.npy (memory-mappable, see packed_connectome.py)
 
     Usage
     -----
@@ -41,14 +48,13 @@ Updated by rcruces march 2023
 """
 
 # Import packages
-import os
-import sys
 import argparse
-import subprocess
 import numpy as np
 import nibabel as nb
-from scipy import spatial
-import pygeodesic.geodesic as geodesic
+from annot_parcellation import load_annot, parcel_centroids
+from geodesic_engine import GeodesicEngine, ExactSolver, save_packed_gd
+from heat_geodesic import HeatSolver
+from gifti_io import n_threads_default
 
 # Arguments
 parser = argparse.ArgumentParser()
@@ -84,6 +90,13 @@ parser.add_argument('-rh_annot',
                     type=str,
                     help='Path to right annotation files in the same surface as rh_surf.'
                     )
+parser.add_argument('-method',
+                    dest='method',
+                    type=str,
+                    default='exact',
+                    choices=['exact', 'heat'],
+                    help='Geodesic distance backend: exact (default) or heat method approximation'
+                    )
 args = parser.parse_args()
 
 # Function save as gifti
@@ -107,6 +120,7 @@ print(f'  -lh_surf      : "{lh_surf}"')
 print(f'  -rh_surf      : "{rh_surf}"')
 print(f'  -outPath      : "{outPath}"')
 print(f'  -parcel_wise  : "{args.parcel_wise}"')
+print(f'  -method       : "{args.method}"')
 if args.parcel_wise==True:
     lh_annot = args.lh_annot
     rh_annot = args.rh_annot
@@ -123,103 +137,57 @@ rh = nb.load(rh_surf)
 vertices_rh = rh.agg_data('NIFTI_INTENT_POINTSET')
 faces_rh = rh.agg_data('NIFTI_INTENT_TRIANGLE')
 
+# Geodesic backend: the heat method factorizes the mesh once and solves the sources
+# in batches in-process, the exact solver runs in OMP_NUM_THREADS worker processes
+if args.method == 'heat':
+    engine_args = {'solver': HeatSolver, 'n_workers': 1, 'batch': 64}
+else:
+    engine_args = {'solver': ExactSolver}
+
+def make_engine(vertices_h, faces_h):
+    return GeodesicEngine(vertices_h, faces_h, **engine_args)
+
 # Calculate GD parcel-wise
 if args.parcel_wise == True:
-    # WORKBENCH COMMAND PATH
-    wbPath = os.popen("which wb_command").read()
-    wbPath = wbPath.replace('wb_command\n', 'wb_command')
-
-    vertices = np.append(vertices_lh, vertices_rh, axis = 0)
-    faces = np.append(faces_lh, faces_rh+len(vertices_lh), axis = 0)
-
-    # Read annotation & join hemispheres
-    [labels_lh, ctab_lh, names_lh] = nb.freesurfer.io.read_annot(lh_annot, orig_ids=True)
-    [labels_rh, ctab_rh, names_rh] = nb.freesurfer.io.read_annot(rh_annot, orig_ids=True)
-    nativeLength = len(labels_lh)+len(labels_rh)
-    parc = np.zeros((nativeLength))
-    for (x, _) in enumerate(labels_lh):
-        parc[x] = np.where(ctab_lh[:,4] == labels_lh[x])[0][0]
-    for (x, _) in enumerate(labels_rh):
-        parc[x + len(labels_lh)] = np.where(ctab_rh[:,4] == labels_rh[x])[0][0] + len(ctab_lh)
-
-    # Find centre vertex
-    uparcel = np.unique(parc)
-    voi = np.zeros([1, len(uparcel)])
+    # Read annotation & join hemispheres (decoded once per annotation, see annot_parcellation)
+    parc, n_lh, _ = load_annot(lh_annot, rh_annot)
 
+    # Find centre vertex: minimum summed distance to the parcel vertices, streamed
+    # in blocks (linear memory) and cached per subject and annotation
+    uparcel = np.unique(parc)
     print("[ INFO ]..... Finding central vertex for each parcel")
-    for (n, _) in enumerate(uparcel):
-        this_parc = np.where(parc == uparcel[n])[0]
-        distances = spatial.distance.pdist(np.squeeze(vertices[this_parc,:]), 'euclidean') # Returns condensed matrix of distances
-        distancesSq = spatial.distance.squareform(distances) # convert to square form
-        sumDist = np.sum(distancesSq, axis = 1) # sum distance across columns
-        index = np.where(sumDist == np.min(sumDist)) # minimum sum distance index
-        voi[0, n] = this_parc[index[0][0]]
+    voi = parcel_centroids(lh_surf, rh_surf, lh_annot, rh_annot)[np.newaxis, :]
 
     # Initialize distance matrix
-    GD = np.empty((uparcel.shape[0], uparcel.shape[0]))
+    GD = np.zeros((uparcel.shape[0], uparcel.shape[0]))
 
     # ---------------------------------------------------------------------
-    # Calculate distance from VERTEX to all other central VERTICES
-    cpus = os.environ['OMP_NUM_THREADS']
-    # Left hemisphere
-    parcL = parc[0:len(labels_lh)]
-    print("[ INFO ]..... Running geodesic distance using {cpus} threads".format(cpus=cpus))
-    N = len(np.unique(labels_lh))
-    # Iterate over each central vertex
-    for ii in range(N):
-        vertex = int(voi[0,ii])
-        voiStr = str(vertex)
-        # Calculate the GD from tha vertex to the rest of the vertices
-        cmdStr = "{wbPath} -surface-geodesic-distance {lh_surf} {voiStr} {outPath}_this_voi.func.gii".format(wbPath=wbPath, lh_surf=lh_surf, voiStr=voiStr, outPath=outPath)
-        subprocess.run(cmdStr.split())
-        # Load file with GD column format
-        tmpname = outPath + '_this_voi.func.gii'
-        tmp = nb.load(tmpname).agg_data()
-        parcGD = np.empty((1, N))
-        for n in range(N):
-            tmpData = tmp[parcL == uparcel[n]]
-            tmpMean = np.mean(tmpData)
-            parcGD[0, n] = tmpMean
-        # Save column on GD matrix
-        GD[ii,:] = np.append(parcGD, np.zeros((parcGD.shape[0], parcGD.shape[1])), axis = 1)
-
-    # Right hemisphere
-    N = len(np.unique(labels_rh))
-    parcR = parc[-len(labels_rh):]
-    # Iterate over each central vertex
-    for ii in range(N):
-        ii_rh = int(ii + len(uparcel)/2)
-        vertex = int(voi[0,ii_rh] - len(vertices_lh))
-        voiStr = str(vertex)
-        # Calculate the GD from tha vertex to the rest of the vertices
-        cmdStr = "{wbPath} -surface-geodesic-distance {rh_surf} {voiStr} {outPath}_this_voi.func.gii".format(wbPath=wbPath, rh_surf=rh_surf, voiStr=voiStr, outPath=outPath)
-        subprocess.run(cmdStr.split())
-        # Load file with GD column format
-        tmpname = outPath + '_this_voi.func.gii'
-        tmp = nb.load(tmpname).agg_data()
-        parcGD = np.empty((1, N))
-        for n in range(N):
-            n_rh = int(n + len(uparcel)/2)
-            tmpData = tmp[parcR == uparcel[n_rh]]
-            tmpMean = np.mean(tmpData)
-            parcGD[0, n] = tmpMean
-        # Save column on GD matrix
-        GD[ii_rh,:] = np.append(np.zeros((parcGD.shape[0], parcGD.shape[1])), parcGD, axis = 1)
+    # Calculate distance from each central VERTEX to all the vertices, in memory:
+    # the mesh is built once per hemisphere and the centroids are processed in batches
+    # by a pool of OMP_NUM_THREADS worker processes, which return the parcel means
+    print("[ INFO ]..... Running {method} geodesic distance using {cpus} workers".format(method=args.method, cpus=engine_args.get('n_workers', n_threads_default())))
+    half = int(len(uparcel)/2)
+    # Left hemisphere: parcel index of each vertex in uparcel[0:N]
+    parcL = parc[0:n_lh]
+    N = len(np.unique(parcL))
+    engine = make_engine(vertices_lh, faces_lh)
+    GD[0:N, 0:N] = engine.label_means(voi[0, 0:N].astype(int), np.searchsorted(uparcel, parcL), n_labels=N)
+
+    # Right hemisphere: parcel index of each vertex in uparcel[half:half+N]
+    parcR = parc[n_lh:]
+    N = len(np.unique(parcR))
+    engine = make_engine(vertices_rh, faces_rh)
+    GD[half:half+N, half:half+N] = engine.label_means(voi[0, half:half+N].astype(int) - len(vertices_lh),
+                                                      np.searchsorted(uparcel, parcR) - half, n_labels=N)
 else:
-    print("[ INFO ]..... Running geodesic distance vertex-wise")
-    # Initialize class to calculate geodesic distance
-    geoalg_L = geodesic.PyGeodesicAlgorithmExact(vertices_lh,faces_lh)
-    geoalg_R = geodesic.PyGeodesicAlgorithmExact(vertices_rh,faces_rh)
-
-    N = vertices_lh.shape[0]
-    GD = np.empty((N*2,N*2), dtype=float)
-    for x in range(0,N,1):
-        # Left vertices
-        dist_L = geoalg_L.geodesicDistances(np.array([x]))[0]
-        GD[x,:] = np.concatenate((dist_L, np.zeros(N)), axis = 0)
-        # Right vertices
-        dist_R = geoalg_R.geodesicDistances(np.array([x]))[0]
-        GD[x+N,:] =  np.concatenate((np.zeros(N), dist_R), axis = 0)
-
-save_gii(GD, outPath+'.shape.gii')
+    print("[ INFO ]..... Running {method} geodesic distance vertex-wise".format(method=args.method))
+    # One float32 packed upper triangle per hemisphere (the cross-hemisphere blocks are zero),
+    # the source vertices are sharded across OMP_NUM_THREADS worker processes
+    for hemi, vertices_h, faces_h in [('L', vertices_lh, faces_lh), ('R', vertices_rh, faces_rh)]:
+        save_packed_gd(make_engine(vertices_h, faces_h), "{outPath}_hemi-{hemi}.triu.npy".format(outPath=outPath, hemi=hemi),
+                       meta={'symmetric': True, 'hemi': hemi}, label=hemi)
+
+# Parcel-wise GD is not symmetric (mean distance from each centroid), the vertex-wise GD is already saved
+if args.parcel_wise == True:
+    save_gii(GD, outPath+'.shape.gii')
 print("[ INFO ]..... Geodesic distance completed")
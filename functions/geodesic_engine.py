@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+In-process geodesic distances on a triangular surface mesh.
+
+The mesh is loaded once and every worker process of the pool builds its own
+exact geodesic solver (pygeodesic, MMP algorithm) from it. The source
+vertices are split in batches across the pool (OMP_NUM_THREADS workers by
+default), each source gives one row of distances to all the vertices. The
+rows can be reduced in the workers to the mean distance of each label (e.g.
+parcel), so only (sources x labels) values come back and no distance is
+written to disk.
+
+    Classes
+    -------
+    ExactSolver    : pygeodesic exact distances of a batch of sources
+    GeodesicEngine : batched, parallel distance rows and label means
+    GeodesicRows   : on-demand distance rows of a surface, LRU cached in memory (and on disk)
+
+    Functions
+    ---------
+    save_packed_gd : vertex-wise distances of a mesh streamed to a float32 packed upper triangle
+"""
+
+from collections import deque, OrderedDict
+import os
+import time
+import hashlib
+import tempfile
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from gifti_io import n_threads_default
+from packed_connectome import create_packed, packed_prefix, triu_offset
+
+
+class ExactSolver:
+    """ Exact geodesic distances (pygeodesic), one source at a time.
+
+    Parameters
+    ----------
+    vertices : array (V x 3)
+    faces : array (F x 3)
+    """
+
+    def __init__(self, vertices, faces):
+        import pygeodesic.geodesic as geodesic
+        self.algorithm = geodesic.PyGeodesicAlgorithmExact(vertices, faces)
+
+    def __call__(self, sources):
+        """ Distances (sources x V) from each source vertex """
+        return np.stack([self.algorithm.geodesicDistances(np.array([s]))[0] for s in sources])
+
+
+# Solver of each worker process, built once by _init_worker
+_worker_solver = None
+
+
+def _init_worker(solver, vertices, faces):
+    global _worker_solver
+    _worker_solver = solver(vertices, faces)
+
+
+def _label_means(dist, labels, counts):
+    """ Mean distance (sources x labels) to the vertices of each label (labels < 0 are ignored) """
+    valid = labels >= 0
+    return np.stack([np.bincount(labels[valid], weights=d[valid], minlength=len(counts)) for d in dist]) / counts
+
+
+def _run_batch(sources, labels, counts, dtype, solver=None):
+    dist = (solver or _worker_solver)(sources)
+    if labels is not None:
+        return _label_means(dist, labels, counts).astype(dtype)
+    return dist.astype(dtype, copy=False)
+
+
+class GeodesicEngine:
+    """ Geodesic distances from many sources, in batches across a process pool.
+
+    Parameters
+    ----------
+    vertices : array (V x 3)
+    faces : array (F x 3)
+    solver : class building a solver from (vertices, faces), called on a batch of sources (default ExactSolver)
+    n_workers : int, number of worker processes. Default is OMP_NUM_THREADS.
+    batch : int, number of sources per task. Default splits the sources in 4 tasks per worker.
+    """
+
+    def __init__(self, vertices, faces, solver=ExactSolver, n_workers=None, batch=None):
+        self.vertices = np.ascontiguousarray(vertices, dtype=np.float64)
+        self.faces = np.ascontiguousarray(faces, dtype=np.int32)
+        self.solver = solver
+        self.n_workers = n_workers or n_threads_default()
+        self.batch = batch
+        self._local = None
+
+    @property
+    def n_vertices(self):
+        return self.vertices.shape[0]
+
+    def _batches(self, sources):
+        size = self.batch or max(1, int(np.ceil(len(sources) / (4 * self.n_workers))))
+        return [sources[i:i + size] for i in range(0, len(sources), size)]
+
+    def _map(self, sources, labels, counts, dtype):
+        """ Yields (batch of sources, result block) in the order of the sources """
+        sources = np.asarray(sources, dtype=int)
+        batches = self._batches(sources)
+        if self.n_workers == 1 or len(batches) == 1:
+            if self._local is None:
+                self._local = self.solver(self.vertices, self.faces)
+            for b in batches:
+                yield b, _run_batch(b, labels, counts, dtype, solver=self._local)
+            return
+        with ProcessPoolExecutor(max_workers=min(self.n_workers, len(batches)), initializer=_init_worker,
+                                 initargs=(self.solver, self.vertices, self.faces)) as pool:
+            # At most two tasks per worker in flight: the finished blocks are consumed in order
+            pending = deque()
+            for b in batches:
+                pending.append((b, pool.submit(_run_batch, b, labels, counts, dtype)))
+                if len(pending) > 2 * self.n_workers:
+                    done, future = pending.popleft()
+                    yield done, future.result()
+            while pending:
+                done, future = pending.popleft()
+                yield done, future.result()
+
+    def rows(self, sources, dtype=np.float32):
+        """ Yields (batch of sources, distances (batch x V)) """
+        return self._map(sources, None, None, dtype)
+
+    def distances(self, sources, dtype=np.float32):
+        """ Distances (sources x V) from each source """
+        return np.concatenate([block for _, block in self.rows(sources, dtype)]) if len(sources) else \
+            np.empty((0, self.n_vertices), dtype=dtype)
+
+    def label_means(self, sources, labels, n_labels=None, dtype=np.float64):
+        """ Mean distance (sources x labels) from each source to the vertices of each label.
+
+        Parameters
+        ----------
+        sources : array of int, source vertices
+        labels : array of int (V), label index of each vertex in 0..L-1 (negative: ignored)
+        n_labels : int, number of labels L (default max(labels) + 1), empty labels are NaN
+        """
+        labels = np.asarray(labels, dtype=int)
+        counts = np.bincount(labels[labels >= 0], minlength=n_labels or 0)
+        return np.concatenate([block for _, block in self._map(sources, labels, counts, dtype)])
+
+
+def save_packed_gd(engine, fileName, meta=None, dtype=np.float32, label=''):
+    """ Vertex-wise geodesic distances of the engine mesh, saved as a packed upper triangle.
+
+    The rows are computed in batches by the engine workers and row i is written
+    as M[i, i:] to the memory-mapped <name>.triu.npy (see packed_connectome.py),
+    so the dense matrix is never held in memory. The progress and the throughput
+    are reported about every 5% of the rows.
+
+    Parameters
+    ----------
+    engine : GeodesicEngine
+    fileName : str, <name>.triu.npy
+    meta : dict, node metadata of the packed connectome
+    label : str, name of the mesh in the progress messages (e.g. the hemisphere)
+    """
+    N = engine.n_vertices
+    # Written under a temporary name, renamed once complete
+    prefix = packed_prefix(fileName)
+    vector = create_packed(prefix + '.partial', N, dtype=dtype, meta=meta)
+    t0 = time.time()
+    done, report = 0, max(1, N // 20)
+    for sources, block in engine.rows(np.arange(N), dtype=dtype):
+        for i, row in zip(sources, block):
+            start = triu_offset(i, N)
+            vector[start:start + N - i] = row[i:]
+        done += len(sources)
+        if done >= report or done == N:
+            elapsed = time.time() - t0
+            print("[ INFO ]..... {label} {done}/{N} rows, {rate:.1f} rows/s".format(label=label, done=done, N=N, rate=done / max(elapsed, 1e-9)))
+            report = done + max(1, N // 20)
+    vector.flush()
+    del vector
+    for ext in ['.triu.npy', '.triu.json']:
+        os.replace(prefix + '.partial' + ext, prefix + ext)
+
+
+class GeodesicRows:
+    """ Geodesic distance rows of a surface, computed on request.
+
+    Only the requested rows are computed (the misses of a query in one engine
+    call), and the last max_rows rows are kept in memory (least recently used
+    out). With cache_dir, every computed row is also saved as a .npy file in
+    a subdirectory named after the mesh and the solver, and read back instead
+    of being recomputed. The disk cache is bounded too: beyond max_disk_rows
+    files, the least recently used rows (oldest modification time, refreshed
+    on every disk hit) are deleted.
+
+        gd = GeodesicRows.from_gifti('<sub>_hemi-L_surf-fsnative_label-midthickness.surf.gii')
+        profile = gd[seed]               # distances (V) from one vertex
+        block = gd.rows([s1, s2, s3])    # distances (3 x V)
+
+    Parameters
+    ----------
+    vertices : array (V x 3)
+    faces : array (F x 3)
+    solver : solver class of the engine (ExactSolver, or heat_geodesic.HeatSolver)
+    max_rows : int, number of rows kept in memory
+    cache_dir : str, directory of the on-disk row cache (default no disk cache)
+    max_disk_rows : int, number of rows kept on disk (None: no limit)
+    n_workers : int, worker processes of the engine (default 1: the queries are small)
+    dtype : dtype of the rows
+    """
+
+    def __init__(self, vertices, faces, solver=ExactSolver, max_rows=1024, cache_dir=None, max_disk_rows=4096,
+                 n_workers=1, dtype=np.float32):
+        self.engine = GeodesicEngine(vertices, faces, solver=solver, n_workers=n_workers)
+        self.max_rows = max_rows
+        self.max_disk_rows = max_disk_rows
+        self.dtype = np.dtype(dtype)
+        self.hits, self.misses = 0, 0
+        self._rows = OrderedDict()
+        self.cache_dir = None
+        if cache_dir is not None:
+            key = hashlib.sha1(self.engine.vertices.tobytes() + self.engine.faces.tobytes()).hexdigest()[:16]
+            self.cache_dir = os.path.join(cache_dir, '{}_{}'.format(solver.__name__, key))
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_gifti(cls, surf, **kwargs):
+        """ Rows of a surface (GIFTI) """
+        import nibabel as nb
+        mesh = nb.load(surf)
+        return cls(mesh.agg_data('NIFTI_INTENT_POINTSET'), mesh.agg_data('NIFTI_INTENT_TRIANGLE'), **kwargs)
+
+    @property
+    def n_vertices(self):
+        return self.engine.n_vertices
+
+    def _row_file(self, i):
+        return os.path.join(self.cache_dir, 'row-{:07d}.npy'.format(i))
+
+    def _remember(self, i, row):
+        self._rows[i] = row
+        self._rows.move_to_end(i)
+        while len(self._rows) > self.max_rows:
+            self._rows.popitem(last=False)
+
+    def _from_disk(self, i):
+        if self.cache_dir is None or not os.path.isfile(self._row_file(i)):
+            return None
+        try:
+            row = np.load(self._row_file(i))
+            # Recently used: the eviction removes the oldest modification times first
+            os.utime(self._row_file(i))
+        except (OSError, ValueError):
+            return None
+        return row.astype(self.dtype, copy=False) if row.shape == (self.n_vertices,) else None
+
+    def _to_disk(self, i, row):
+        # Atomic write: several processes can share the cache
+        fd, tmp = tempfile.mkstemp(suffix='.npy', dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, row)
+        os.replace(tmp, self._row_file(i))
+
+    def _disk_rows(self):
+        """ (mtime, size, path) of the rows in the disk cache """
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.startswith('row-') and entry.name.endswith('.npy'):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, entry.path))
+        return files
+
+    def _evict_disk(self):
+        """ Deletes the least recently used rows beyond max_disk_rows """
+        if self.max_disk_rows is None:
+            return
+        files = self._disk_rows()
+        if len(files) <= self.max_disk_rows:
+            return
+        for _, _, path in sorted(files)[:len(files) - self.max_disk_rows]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def rows(self, sources):
+        """ Distances (sources x V) from each source vertex, the missing rows are computed in one batch """
+        sources = np.asarray(sources, dtype=int).ravel()
+        if np.any((sources < 0) | (sources >= self.n_vertices)):
+            raise IndexError('Source vertices out of range [0, {})'.format(self.n_vertices))
+        out = np.empty((len(sources), self.n_vertices), dtype=self.dtype)
+        missing = OrderedDict()
+        for n, i in enumerate(sources.tolist()):
+            row = self._rows.get(i)
+            if row is None:
+                row = self._from_disk(i)
+                if row is not None:
+                    self._remember(i, row)
+            if row is None:
+                missing.setdefault(i, []).append(n)
+                continue
+            self._rows.move_to_end(i)
+            self.hits += 1
+            out[n] = row
+        if missing:
+            self.misses += len(missing)
+            for batch, block in self.engine.rows(np.fromiter(missing, dtype=int, count=len(missing)), dtype=self.dtype):
+                for i, row in zip(batch.tolist(), block):
+                    row = np.array(row)
+                    out[missing[i]] = row
+                    self._remember(i, row)
+                    if self.cache_dir is not None:
+                        self._to_disk(i, row)
+            if self.cache_dir is not None:
+                self._evict_disk()
+        return out
+
+    def __getitem__(self, i):
+        """ Distances (V) from vertex i """
+        return self.rows([i])[0]
+
+    def cache_info(self):
+        info = {'hits': self.hits, 'misses': self.misses, 'in_memory': len(self._rows), 'max_rows': self.max_rows}
+        if self.cache_dir is not None:
+            files = self._disk_rows()
+            info.update({'on_disk': len(files), 'disk_bytes': sum(size for _, size, _ in files),
+                         'max_disk_rows': self.max_disk_rows})
+        return info
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Fast loaders for GIFTI data arrays (func.gii / shape.gii).
+
+nibabel decodes every darray serially and the callers then copied them one by
+one into a float64 matrix. These loaders parse the XML once, preallocate a
+single float32 output buffer and decode the darrays (base64 / gzip) in parallel
+worker threads, writing each one directly into its row of the buffer.
+When the GIFTI uses external binary storage with contiguous darrays, the data
+of the file is memory-mapped (copy-on-write) instead of decoded: a single file
+is returned as the memmap itself, several files (e.g. [lh, rh]) are copied
+block by block from their memmaps into the output buffer.
+
+Used by 03_FC.py, surf2mpc.py and build_mpc-vertex.py.
+
+    Functions
+    ---------
+    load_func_gii   : timeseries (T x V) from one file per hemisphere (T darrays each)
+    load_gii_stack  : (files x V) matrix from single darray files (e.g. one per surface depth)
+    iter_func_gii   : streams the darrays of a file one at a time
+"""
+
+import os
+import base64
+import zlib
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# GIFTI DataType -> numpy type
+_DTYPES = {'NIFTI_TYPE_UINT8': 'u1', 'NIFTI_TYPE_INT8': 'i1',
+           'NIFTI_TYPE_UINT16': 'u2', 'NIFTI_TYPE_INT16': 'i2',
+           'NIFTI_TYPE_UINT32': 'u4', 'NIFTI_TYPE_INT32': 'i4',
+           'NIFTI_TYPE_UINT64': 'u8', 'NIFTI_TYPE_INT64': 'i8',
+           'NIFTI_TYPE_FLOAT32': 'f4', 'NIFTI_TYPE_FLOAT64': 'f8'}
+
+
+def n_threads_default():
+    """ Number of worker threads: OMP_NUM_THREADS or all the cpus """
+    return max(1, int(os.environ.get('OMP_NUM_THREADS', os.cpu_count() or 1)))
+
+
+class _DataArray:
+    """ Header and raw (encoded) content of one GIFTI DataArray """
+
+    def __init__(self, attrib, text, gii_dir):
+        self.encoding = attrib.get('Encoding', 'ASCII')
+        endian = '>' if attrib.get('Endian', 'LittleEndian') == 'BigEndian' else '<'
+        self.dtype = np.dtype(_DTYPES[attrib['DataType']]).newbyteorder(endian)
+        dims = [int(attrib['Dim{}'.format(i)]) for i in range(int(attrib.get('Dimensionality', 1)))]
+        self.size = int(np.prod(dims))
+        self.text = text
+        self.external = attrib.get('ExternalFileName', '')
+        if self.external and not os.path.isabs(self.external):
+            self.external = os.path.join(gii_dir, self.external)
+        self.offset = int(attrib.get('ExternalFileOffset', 0) or 0)
+
+    def decode(self, out):
+        """ Decodes the data array into out (1D view of the preallocated buffer) """
+        if self.encoding == 'ExternalFileBinary':
+            data = np.memmap(self.external, dtype=self.dtype, mode='r', offset=self.offset, shape=(self.size,))
+        elif self.encoding == 'GZipBase64Binary':
+            data = np.frombuffer(zlib.decompress(base64.b64decode(self.text)), dtype=self.dtype)
+        elif self.encoding == 'Base64Binary':
+            data = np.frombuffer(base64.b64decode(self.text), dtype=self.dtype)
+        else:
+            data = np.array(self.text.split(), dtype=self.dtype)
+        if data.size != out.size:
+            raise ValueError('GIFTI data array has {} values, expected {}'.format(data.size, out.size))
+        out[:] = data
+        self.text = None
+
+
+def _iter_raw(fname):
+    """ Parses a GIFTI file and yields its (still encoded) data arrays one at a time """
+    gii_dir = os.path.dirname(os.path.abspath(fname))
+    for _, elem in ET.iterparse(fname, events=('end',)):
+        if elem.tag == 'DataArray':
+            data = elem.find('Data')
+            yield _DataArray(elem.attrib, data.text if data is not None else '', gii_dir)
+            elem.clear()
+
+
+def read_darrays(fname):
+    """ Parses a GIFTI file and returns its (still encoded) data arrays """
+    return list(_iter_raw(fname))
+
+
+def iter_func_gii(fname, dtype=np.float64):
+    """ Yields the decoded darrays (e.g. timepoints) of a GIFTI file one at a time.
+
+    Only one darray is held in memory, for single-pass statistics over long runs.
+    """
+    for darray in _iter_raw(fname):
+        out = np.empty(darray.size, dtype=dtype)
+        darray.decode(out)
+        yield out
+
+
+def _memmap_darrays(darrays, dtype=None):
+    """ Copy-on-write memmap (T x V) if the darrays are contiguous in one external file (of dtype), else None """
+    first = darrays[0]
+    if (first.encoding != 'ExternalFileBinary' or (dtype is not None and first.dtype != np.dtype(dtype))
+            or any(d.encoding != 'ExternalFileBinary' or d.external != first.external or d.dtype != first.dtype
+                   or d.size != first.size or d.offset != first.offset + i * first.size * first.dtype.itemsize
+                   for i, d in enumerate(darrays))):
+        return None
+    return np.memmap(first.external, dtype=first.dtype, mode='c', offset=first.offset,
+                     shape=(len(darrays), first.size))
+
+
+def _decode_all(jobs, n_threads):
+    """ Decodes (darray, out) jobs in a pool of worker threads """
+    n_threads = n_threads or n_threads_default()
+    if n_threads == 1:
+        for darray, out in jobs:
+            darray.decode(out)
+        return
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        # list() propagates the exceptions of the workers
+        list(pool.map(lambda job: job[0].decode(job[1]), jobs))
+
+
+def load_func_gii(fnames, dtype=np.float32, n_threads=None, return_widths=False):
+    """ Loads GIFTI timeseries (one darray per timepoint) as a (T x V) matrix.
+
+    Parameters
+    ----------
+    fnames : str or list of str
+        GIFTI file, or files concatenated along vertices (e.g. [lh, rh]).
+    dtype : numpy dtype of the output, default float32
+    n_threads : int, number of decoding threads. Default is OMP_NUM_THREADS.
+    return_widths : bool, also return the number of vertices of each file
+
+    Return
+    ------
+    data : array (timepoints x vertices)
+    widths : list of int, with return_widths
+    """
+    if isinstance(fnames, str):
+        fnames = [fnames]
+    files = [read_darrays(f) for f in fnames]
+    # Memmap of each file with external binary storage (None for encoded files)
+    maps = [_memmap_darrays(darrays) for darrays in files]
+
+    # Zero-copy path for a single external binary file of the output dtype
+    if len(files) == 1 and maps[0] is not None and maps[0].dtype == np.dtype(dtype):
+        return (maps[0], [maps[0].shape[1]]) if return_widths else maps[0]
+
+    n_time = len(files[0])
+    if any(len(darrays) != n_time for darrays in files):
+        raise ValueError('GIFTI files have a different number of timepoints: ' + ', '.join(fnames))
+    widths = [darrays[0].size for darrays in files]
+    out = np.empty((n_time, sum(widths)), dtype=dtype)
+    jobs = []
+    start = 0
+    for darrays, width, mapped in zip(files, widths, maps):
+        if mapped is not None:
+            out[:, start:start + width] = mapped
+        else:
+            for n, darray in enumerate(darrays):
+                jobs.append((darray, out[n, start:start + width]))
+        start += width
+    _decode_all(jobs, n_threads)
+    return (out, widths) if return_widths else out
+
+
+def load_gii_stack(*columns, dtype=np.float32, n_threads=None, return_widths=False):
+    """ Stacks the first darray of several GIFTI files into a (files x V) matrix.
+
+    Parameters
+    ----------
+    columns : lists of str
+        One list of files per block of vertices, each file is one row
+        (e.g. load_gii_stack(lh_files, rh_files) concatenates hemispheres).
+    dtype : numpy dtype of the output, default float32
+    n_threads : int, number of decoding threads. Default is OMP_NUM_THREADS.
+    return_widths : bool, also return the number of vertices of each column
+
+    Return
+    ------
+    data : array (files x vertices)
+    widths : list of int, with return_widths
+    """
+    n_rows = len(columns[0])
+    if any(len(fnames) != n_rows for fnames in columns):
+        raise ValueError('All the columns must have the same number of files')
+    n_threads = n_threads or n_threads_default()
+    # XML parsing is also done in parallel, one file per worker
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        darrays = [list(pool.map(lambda f: read_darrays(f)[0], fnames)) for fnames in columns]
+    widths = [col[0].size for col in darrays]
+    out = np.empty((n_rows, sum(widths)), dtype=dtype)
+    jobs = []
+    start = 0
+    for col, width in zip(darrays, widths):
+        for n, darray in enumerate(col):
+            jobs.append((darray, out[n, start:start + width]))
+        start += width
+    _decode_all(jobs, n_threads)
+    return (out, widths) if return_widths else out
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Approximate geodesic distances with the heat method (Crane, Weischedel & Wardetzky, 2013).
+
+The cotangent Laplacian L and the lumped mass matrix M of the mesh are built
+once and the two sparse systems of the method are factorized once:
+
+    1. heat flow          (M + t L) u = delta_source     t = (mean edge length)^2
+    2. normalized field   X = -grad(u) / |grad(u)|        (per face)
+    3. Poisson equation   L phi = -div(X)                 (phi pinned at vertex 0)
+
+so every source costs two sparse back-substitutions and a few sparse
+products. The gradient and divergence operators are sparse matrices, so a
+batch of sources is solved at once (multi right-hand sides).
+
+The solver has the same interface as geodesic_engine.ExactSolver and can be
+used by GeodesicEngine (solver=HeatSolver).
+
+    Usage (validation report against the exact backend)
+    -----
+    heat_geodesic.py <surf.gii> [-n_sources 200] [-seed 0]
+"""
+
+import time
+import argparse
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import splu
+
+
+def cotangent_operators(vertices, faces):
+    """ Cotangent Laplacian (positive semi-definite), lumped mass, gradient and divergence operators.
+
+    Return
+    ------
+    L : csc_matrix (V x V)
+    mass : array (V), one third of the area of the faces of each vertex
+    grad : list of 3 csr_matrix (F x V), x, y and z components of the face gradient of a vertex function
+    div : list of 3 csr_matrix (V x F), divergence of a face vector field (x, y and z components)
+    mean_edge : float, mean edge length
+    """
+    V = vertices.shape[0]
+    F = faces.shape[0]
+    a, b, c = faces[:, 0], faces[:, 1], faces[:, 2]
+    pa, pb, pc = vertices[a], vertices[b], vertices[c]
+    normal = np.cross(pb - pa, pc - pa)
+    double_area = np.linalg.norm(normal, axis=1)
+    unit = normal / double_area[:, None]
+
+    # Cotangent of the angle at each corner
+    def cot(p, q, r):
+        u, v = q - p, r - p
+        return np.einsum('ij,ij->i', u, v) / np.linalg.norm(np.cross(u, v), axis=1)
+    cot_a, cot_b, cot_c = cot(pa, pb, pc), cot(pb, pc, pa), cot(pc, pa, pb)
+
+    # Laplacian: edge (b, c) has weight cot_a / 2, etc.
+    i = np.concatenate([b, c, a])
+    j = np.concatenate([c, a, b])
+    w = np.concatenate([cot_a, cot_b, cot_c]) / 2
+    W = sparse.coo_matrix((np.concatenate([w, w]), (np.concatenate([i, j]), np.concatenate([j, i]))), shape=(V, V)).tocsr()
+    L = (sparse.diags(np.asarray(W.sum(axis=1)).ravel()) - W).tocsc()
+
+    mass = np.bincount(faces.ravel(), weights=np.repeat(double_area / 6, 3), minlength=V)
+
+    # Gradient of the hat function of each corner: N x (opposite edge) / (2 area)
+    rows = np.repeat(np.arange(F), 3)
+    cols = faces.ravel()
+    g = np.stack([np.cross(unit, pc - pb), np.cross(unit, pa - pc), np.cross(unit, pb - pa)], axis=1) / double_area[:, None, None]
+    grad = [sparse.csr_matrix((g[:, :, d].ravel(), (rows, cols)), shape=(F, V)) for d in range(3)]
+
+    # Divergence at each corner: (cot_2 e_1 + cot_1 e_2) / 2, e_1 and e_2 the edges leaving the corner
+    dv = np.stack([cot_c[:, None] * (pb - pa) + cot_b[:, None] * (pc - pa),
+                   cot_a[:, None] * (pc - pb) + cot_c[:, None] * (pa - pb),
+                   cot_b[:, None] * (pa - pc) + cot_a[:, None] * (pb - pc)], axis=1) / 2
+    div = [sparse.csr_matrix((dv[:, :, d].ravel(), (cols, rows)), shape=(V, F)) for d in range(3)]
+
+    edges = np.concatenate([pb - pa, pc - pb, pa - pc])
+    return L, mass, grad, div, float(np.mean(np.linalg.norm(edges, axis=1)))
+
+
+class HeatSolver:
+    """ Heat method geodesic distances, prefactorized.
+
+    Parameters
+    ----------
+    vertices : array (V x 3)
+    faces : array (F x 3)
+    t : float, time step of the heat flow. Default is the squared mean edge length.
+    batch : int, number of sources solved at once (right-hand sides)
+    """
+
+    def __init__(self, vertices, faces, t=None, batch=64):
+        vertices = np.asarray(vertices, dtype=np.float64)
+        faces = np.asarray(faces, dtype=np.int64)
+        L, mass, self.grad, self.div, h = cotangent_operators(vertices, faces)
+        self.t = h ** 2 if t is None else t
+        self.batch = batch
+        self.n = vertices.shape[0]
+        self.heat = splu((sparse.diags(mass) + self.t * L).tocsc())
+        # Poisson system pinned at vertex 0 (L is singular, constant null space)
+        self.poisson = splu(L[1:, 1:].tocsc())
+
+    def __call__(self, sources):
+        """ Distances (sources x V) from each source vertex """
+        sources = np.asarray(sources, dtype=int)
+        out = np.empty((len(sources), self.n))
+        for k in range(0, len(sources), self.batch):
+            src = sources[k:k + self.batch]
+            delta = np.zeros((self.n, len(src)))
+            delta[src, np.arange(len(src))] = 1
+            u = self.heat.solve(delta)
+            X = np.stack([g @ u for g in self.grad])
+            X /= np.maximum(np.linalg.norm(X, axis=0), np.finfo(float).tiny)
+            rhs = sum(d @ x for d, x in zip(self.div, X))
+            phi = np.zeros((self.n, len(src)))
+            # L phi = -div(-grad u / |grad u|)
+            phi[1:] = self.poisson.solve(np.ascontiguousarray(rhs[1:]))
+            phi -= phi[src, np.arange(len(src))]
+            out[k:k + len(src)] = np.maximum(phi, 0).T
+        return out
+
+
+def validation_report(vertices, faces, n_sources=200, seed=0, exact=None):
+    """ Error of the heat method against the exact backend on random sources.
+
+    Return
+    ------
+    report : dict, timings and absolute / relative errors (excluding the sources)
+    """
+    rng = np.random.default_rng(seed)
+    sources = rng.choice(vertices.shape[0], size=min(n_sources, vertices.shape[0]), replace=False)
+    if exact is None:
+        from geodesic_engine import ExactSolver
+        exact = ExactSolver
+    t0 = time.time()
+    heat = HeatSolver(vertices, faces)
+    t_factor = time.time() - t0
+    t0 = time.time()
+    approx = heat(sources)
+    t_heat = time.time() - t0
+    t0 = time.time()
+    reference = exact(vertices, faces)(sources)
+    t_exact = time.time() - t0
+    mask = reference > 0
+    abs_err = np.abs(approx - reference)[mask]
+    rel_err = abs_err / reference[mask]
+    return {'n_vertices': int(vertices.shape[0]), 'n_sources': int(len(sources)),
+            'factorization_s': t_factor, 'heat_s': t_heat, 'exact_s': t_exact,
+            'abs_error_mean': float(abs_err.mean()), 'abs_error_max': float(abs_err.max()),
+            'rel_error_mean': float(rel_err.mean()), 'rel_error_median': float(np.median(rel_err)),
+            'rel_error_p95': float(np.percentile(rel_err, 95))}
+
+
+if __name__ == '__main__':
+    import nibabel as nb
+    parser = argparse.ArgumentParser(description='Heat method geodesic distance against the exact backend')
+    parser.add_argument('surf', help='Surface (GIFTI), e.g. fsLR-5k midthickness')
+    parser.add_argument('-n_sources', type=int, default=200, help='Number of random source vertices')
+    parser.add_argument('-seed', type=int, default=0, help='Seed of the random sources')
+    args = parser.parse_args()
+    surf = nb.load(args.surf)
+    report = validation_report(surf.agg_data('NIFTI_INTENT_POINTSET'), surf.agg_data('NIFTI_INTENT_TRIANGLE'),
+                               n_sources=args.n_sources, seed=args.seed)
+    print("[ INFO ]..... Heat method validation on " + args.surf)
+    for key, value in report.items():
+        print("  {key:<18}: {value:.6g}".format(key=key, value=value))
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Nuisance signal regression with a shared confound design.
+
+The confound model of a functional run is the same for every data block
+(subcortex/cerebellum, fsLR-32k, fsLR-5k). It is factorized once with an SVD
+based pseudoinverse and the residualizing projection is applied in place,
+block by block, in float32.
+
+The projection reproduces the previous sklearn model:
+    slm = LinearRegression().fit(mdl, Data)
+    Data_corr = Data - np.dot(mdl, slm.coef_.T)
+i.e. the slopes are estimated with an intercept, but only the slope term is
+removed from the data.
+
+In censoring mode the frames flagged in spikeRegressors_FD are dropped from
+the data and from the design instead of adding one regressor per spike. For
+the retained frames the result is the same as the spike model (a one-hot
+column only absorbs its own frame), with a much smaller design.
+"""
+
+import numpy as np
+
+
+def expand_dim(Data):
+    if Data.ndim == 1:
+        Data = np.expand_dims(Data, axis=1)
+    return Data
+
+
+def censored_frames(x_spike):
+    """ Indices of the frames flagged in the spikeRegressors_FD file (empty if there is no file) """
+    if not x_spike:
+        return np.array([], dtype=int)
+    spike = expand_dim(np.loadtxt(x_spike))
+    return np.flatnonzero(np.any(spike != 0, axis=1))
+
+
+def load_design(x_spike, x_dof, x_wm, x_csf, x_gs, performNSR, performGSR, gsr, censor=False):
+    """ Loads the confound files and builds the regression design matrix.
+        By default will regress motion parameters and spikeRegressors
+
+    Parameters
+    ----------
+    x_spike : str (spikeRegressors_FD file, empty string if missing)
+    x_dof : str (motion parameters file)
+    x_wm : str (white matter signal file)
+    x_csf : str (CSF signal file)
+    x_gs : str (global signal file)
+    performNSR : str (0,1)
+    performGSR : str (0,1)
+    gsr : str (0,1)
+    censor : bool, leave the spikes out of the design (the frames are censored, see censored_frames)
+
+    Return
+    ------
+    mdl : array (timepoints x regressors), first column is the intercept
+    model : str, description of the model
+    """
+    dof = np.loadtxt(x_dof)
+    csf = expand_dim(np.loadtxt(x_csf))
+    wm = expand_dim(np.loadtxt(x_wm))
+    gs = expand_dim(np.loadtxt(x_gs))
+    if x_spike and not censor:
+        spike = expand_dim(np.loadtxt(x_spike))
+        ones = np.ones((spike.shape[0], 1))
+        if performNSR == "1":
+            model, mdl = 'func ~ spikes + dof + wm + csf', [ones, spike, dof, wm, csf]
+        elif performGSR == "1":
+            model, mdl = 'func ~ spikes + dof + wm + csf + gs', [ones, spike, dof, wm, csf, gs]
+        elif gsr == "1":
+            model, mdl = 'func ~ spikes + gs', [ones, spike, gs]
+        else:
+            model, mdl = 'Default model : func ~ spikes', [ones, spike]
+    else:
+        ones = np.ones((wm.shape[0], 1))
+        if not x_spike:
+            print('NO spikeRegressors_FD file, will skip loading spikes')
+        if performNSR == "1":
+            model, mdl = 'func ~ dof + wm + csf', [ones, dof, wm, csf]
+        elif performGSR == "1":
+            model, mdl = 'func ~ dof + wm + csf + gs', [ones, dof, wm, csf, gs]
+        elif gsr == "1":
+            model, mdl = 'func ~ gs', [ones, gs]
+        else:
+            model, mdl = 'none', [ones]
+        if x_spike:
+            model = model + ' (spike frames censored)'
+    return np.concatenate(mdl, axis=1), model
+
+
+class ConfoundProjector:
+    """ Residualizing projection of a confound design, factorized once.
+
+    The design is split in the intercept and the regressors X. With the
+    centered regressors Xc = U S V', the sklearn slopes are b = V S^-1 U' Y
+    (U is orthogonal to the intercept, so Y does not need to be centered),
+    and the corrected data is Y - (X V S^-1) (U' Y). Both T x r factors are
+    stored in float32 and applied to the data in vertex chunks.
+
+    Parameters
+    ----------
+    mdl : array (timepoints x regressors), first column is the intercept
+    dtype : numpy dtype of the factors and of the corrected data
+    chunk : int, number of columns processed at once
+    censored : array of int, frames removed from the design and from the data
+
+    Attributes
+    ----------
+    rank : int, rank of the centered regressors
+    censored : array of int, censored frames (sorted)
+    """
+
+    def __init__(self, mdl, dtype=np.float32, chunk=8192, censored=None):
+        mdl = np.asarray(mdl, dtype=np.float64)
+        self.n_timepoints = mdl.shape[0]
+        self.censored = np.unique(np.asarray([] if censored is None else censored, dtype=int))
+        self.keep = np.ones(self.n_timepoints, dtype=bool)
+        self.keep[self.censored] = False
+        if not self.keep.any():
+            raise ValueError('All the {} frames are censored'.format(self.n_timepoints))
+        mdl = mdl[self.keep]
+        X = mdl[:, 1:]
+        self.dtype = np.dtype(dtype)
+        self.chunk = chunk
+        # Only the intercept: nothing to regress
+        if X.shape[1] == 0:
+            self.rank = 0
+            self.A = self.B = None
+            return
+        Xc = X - X.mean(axis=0)
+        U, S, Vt = np.linalg.svd(Xc, full_matrices=False)
+        # Same cutoff as numpy.linalg.pinv/lstsq (minimum norm solution)
+        keep = S > S.max() * max(Xc.shape) * np.finfo(np.float64).eps
+        self.rank = int(np.sum(keep))
+        self.A = np.ascontiguousarray((X @ Vt[keep].T) / S[keep], dtype=self.dtype)
+        self.B = np.ascontiguousarray(U[:, keep].T, dtype=self.dtype)
+
+    def apply(self, Data):
+        """ Removes the confounds from Data (timepoints x N) in place.
+
+        Data is converted to the projector dtype first if needed, in that case
+        the returned array is a new one. With censored frames, the returned
+        array is a new one with only the retained frames.
+        """
+        Data = np.asarray(Data, dtype=self.dtype)
+        if Data.shape[0] != self.n_timepoints:
+            raise ValueError('Data has {} timepoints, but the confound model has {}'.format(Data.shape[0], self.n_timepoints))
+        if self.censored.size:
+            Data = Data[self.keep]
+        if self.rank == 0:
+            return Data
+        for i in range(0, Data.shape[1], self.chunk):
+            block = Data[:, i:i + self.chunk]
+            block -= self.A @ (self.B @ block)
+        return Data
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Packed upper-triangle storage of symmetric connectomes.
+
+micapipe connectomes (FC, MPC, SC, vertex-wise GD) are symmetric and were saved
+as full square .shape.gii files with a zero lower triangle. The packed format
+stores only the upper triangle (diagonal included) as a condensed vector:
+
+    <name>.triu.npy   : row-major upper triangle, row i holds M[i, i:] and starts
+                        at i*N - i*(i-1)/2. Plain .npy, memory-mappable.
+    <name>.triu.json  : node metadata {"n_nodes", "dtype", "layout", ...}
+
+A stack of connectomes (e.g. the windows of a dynamic FC) is stored as a 2D
+.triu.npy (frames x upper triangle) and "n_frames" in the metadata.
+
+<name> is the connectome file name without '.shape.gii', so the packed file is
+written next to (or, with MICAPIPE_CONNECTOME_FORMAT=packed, instead of) the GIFTI.
+
+    Readers
+    -------
+    PackedConnectome : lazy access to the vector, rows or the mirrored square
+    load_connectome  : square matrix from a .shape.gii path, using the packed twin if it exists
+"""
+
+import os
+import json
+import numpy as np
+import nibabel as nb
+
+LAYOUT = 'upper-triangle-row-major'
+
+
+def triu_size(N):
+    """ Number of values of the upper triangle (with diagonal) of a N x N matrix """
+    return N * (N + 1) // 2
+
+
+def triu_offset(i, N):
+    """ Position of M[i, i] in the packed upper triangle """
+    return i * N - i * (i - 1) // 2
+
+
+def packed_prefix(fileName):
+    """ Removes the connectome extension (.shape.gii, .triu.npy, .triu.json) """
+    for ext in ['.shape.gii', '.triu.npy', '.triu.json']:
+        if fileName.endswith(ext):
+            return fileName[:-len(ext)]
+    return fileName
+
+
+def _write_meta(prefix, N, dtype, meta, n_frames=None):
+    header = {'n_nodes': int(N), 'dtype': np.dtype(dtype).name, 'layout': LAYOUT}
+    if n_frames is not None:
+        header['n_frames'] = int(n_frames)
+    header.update(meta or {})
+    with open(prefix + '.triu.json', 'w') as f:
+        json.dump(header, f, indent=2)
+
+
+def create_packed(fileName, N, dtype=np.float32, meta=None, n_frames=None):
+    """ Creates an empty packed connectome and returns its writable memmap vector.
+
+    With n_frames, creates a stack of connectomes (n_frames x N*(N+1)/2).
+    """
+    prefix = packed_prefix(fileName)
+    _write_meta(prefix, N, dtype, meta, n_frames)
+    shape = (triu_size(N),) if n_frames is None else (int(n_frames), triu_size(N))
+    return np.lib.format.open_memmap(prefix + '.triu.npy', mode='w+', dtype=dtype, shape=shape)
+
+
+def save_packed(M, fileName, dtype=np.float32, meta=None):
+    """ Saves the upper triangle of the square matrix M in the packed format """
+    N = M.shape[0]
+    vector = create_packed(fileName, N, dtype, meta)
+    for i in range(N):
+        start = triu_offset(i, N)
+        vector[start:start + N - i] = M[i, i:]
+    vector.flush()
+    del vector
+
+
+def save_gii(data_array, file_name, meta=None):
+    # Initialize gifti: NIFTI_INTENT_SHAPE - 2005, FLOAT32 - 16
+    gifti_data = nb.gifti.GiftiDataArray(data=data_array, intent=2005, datatype=16)
+
+    # this is the GiftiImage class, meta values are saved as json strings
+    if meta:
+        meta = nb.gifti.GiftiMetaData({key: json.dumps(value) for key, value in meta.items()})
+    gifti_img = nb.gifti.GiftiImage(meta=meta or None, darrays=[gifti_data])
+
+    # Save the new GIFTI file
+    nb.save(img=gifti_img, filename=file_name)
+
+
+def save_connectome(M, fileName, meta=None):
+    """ Saves a symmetric connectome (upper triangle) as .shape.gii and/or packed.
+
+    The format is selected with the environment variable MICAPIPE_CONNECTOME_FORMAT:
+    'both' (default), 'gifti' or 'packed'. The metadata (e.g. atlas, censored frames)
+    is written in the GIFTI metadata (json values) and in the .triu.json sidecar.
+    """
+    fmt = os.environ.get('MICAPIPE_CONNECTOME_FORMAT', 'both')
+    if fmt not in ['both', 'gifti', 'packed']:
+        raise ValueError('MICAPIPE_CONNECTOME_FORMAT must be both, gifti or packed, not ' + fmt)
+    if fmt != 'packed':
+        save_gii(M, packed_prefix(fileName) + '.shape.gii', meta=meta)
+    if fmt != 'gifti':
+        save_packed(M, fileName, meta=meta)
+
+
+class PackedConnectome:
+    """ Lazy reader of a packed connectome.
+
+    Parameters
+    ----------
+    fileName : str, <name>.triu.npy, <name>.triu.json, <name>.shape.gii or <name>
+
+    Attributes
+    ----------
+    n : number of nodes
+    n_frames : number of connectomes of a stack, None for a single connectome
+    meta : dict, node metadata
+    vector : memmap, condensed upper triangle (loaded on first access)
+    """
+
+    def __init__(self, fileName):
+        self.prefix = packed_prefix(fileName)
+        with open(self.prefix + '.triu.json') as f:
+            self.meta = json.load(f)
+        self.n = self.meta['n_nodes']
+        self.n_frames = self.meta.get('n_frames')
+        self._vector = None
+
+    @staticmethod
+    def exists(fileName):
+        prefix = packed_prefix(fileName)
+        return os.path.isfile(prefix + '.triu.json') and os.path.isfile(prefix + '.triu.npy')
+
+    @property
+    def vector(self):
+        if self._vector is None:
+            self._vector = np.load(self.prefix + '.triu.npy', mmap_mode='r')
+        return self._vector
+
+    def frame(self, k=None):
+        """ Condensed upper triangle of the frame k of a stack (the whole vector if k is None) """
+        if k is None:
+            if self.n_frames is not None:
+                raise ValueError('Stack of {} connectomes, a frame must be selected'.format(self.n_frames))
+            return self.vector
+        if self.n_frames is None:
+            raise ValueError('Not a stack of connectomes')
+        return self.vector[k]
+
+    def row(self, i, frame=None):
+        """ Row i of the mirrored matrix """
+        N = self.n
+        vector = self.frame(frame)
+        out = np.empty(N, dtype=vector.dtype)
+        start = triu_offset(i, N)
+        out[i:] = vector[start:start + N - i]
+        # M[r, i] for r < i (column i of the upper triangle)
+        r = np.arange(i)
+        out[:i] = vector[r * N - r * (r - 1) // 2 + (i - r)]
+        return out
+
+    def square(self, mirror=True, dtype=np.float32, frame=None):
+        """ N x N matrix, mirrored (symmetric) or upper triangle only (as in the GIFTI) """
+        N = self.n
+        vector = self.frame(frame)
+        M = np.zeros((N, N), dtype=dtype)
+        for i in range(N):
+            start = triu_offset(i, N)
+            M[i, i:] = vector[start:start + N - i]
+            if mirror:
+                M[i + 1:, i] = M[i, i + 1:]
+        return M
+
+
+def load_connectome(fileName, mirror=False, dtype=np.float32):
+    """ Loads a connectome square matrix, from its packed twin if it exists.
+
+    Parameters
+    ----------
+    fileName : str, path to the .shape.gii (or packed) connectome
+    mirror : bool, fill the lower triangle. Only for upper triangle (symmetric) connectomes.
+
+    Return
+    ------
+    M : array (N x N)
+    """
+    if PackedConnectome.exists(fileName):
+        return PackedConnectome(fileName).square(mirror=mirror, dtype=dtype)
+    M = np.asarray(nb.load(fileName).darrays[0].data, dtype=dtype)
+    if mirror:
+        M = np.triu(M, 1) + M.T
+    return M
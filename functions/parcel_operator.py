@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Sparse parcel-averaging operators for the conte69 (fsLR-32k) parcellations.
+
+Each `<atlas>_conte69.csv` of micapipe's parcellations directory is turned into
+a sparse (vertices x parcels) averaging operator, so a (timepoints x vertices)
+matrix is parcellated with a single sparse product instead of one boolean mask
+and np.nanmean per label. Operators are cached on disk as npz files and rebuilt
+only when the content of the CSV changes (sha1).
+
+The cache lives in `<parcDir>/cache` (built once per micapipe install), or in
+$MICAPIPE_CACHE or ~/.cache/micapipe/parcellations when the install directory is
+not writable.
+
+    Usage
+    -----
+    parcel_operator.py <parcDir>    # builds the cache of every conte69 parcellation
+"""
+
+import os
+import sys
+import glob
+import hashlib
+import tempfile
+import numpy as np
+import scipy.sparse as ssp
+
+
+class ParcelOperator:
+    """ NaN-aware label-averaging operator.
+
+    Parameters
+    ----------
+    labels : array (vertices,), parcel column of each vertex
+    uparcel : array (parcels,), sorted unique labels of the parcellation
+    """
+
+    def __init__(self, labels, uparcel):
+        self.uparcel = np.asarray(uparcel)
+        labels = np.asarray(labels, dtype=np.int32)
+        n_vertex, n_parcel = len(labels), len(self.uparcel)
+        self.counts = np.bincount(labels, minlength=n_parcel).astype(np.float32)
+        # Indicator and averaging weights, both (parcels x vertices) CSR with one row per parcel,
+        # applied to the transposed data (vertices x timepoints)
+        self.indicator = ssp.csr_matrix((np.ones(n_vertex, dtype=np.float32), (labels, np.arange(n_vertex))),
+                                        shape=(n_parcel, n_vertex))
+        self.weights = ssp.csr_matrix((1 / self.counts[labels], (labels, np.arange(n_vertex))),
+                                      shape=(n_parcel, n_vertex))
+
+    def __call__(self, data, valid=None):
+        """ Average data (timepoints x vertices) within each parcel.
+
+        Parameters
+        ----------
+        data : array (timepoints x vertices), NaNs replaced by zeros if valid is given
+        valid : array (timepoints x vertices) float32, 1 where data is finite.
+                None if data has no NaNs (see nan_split).
+
+        Return
+        ------
+        ts : array (timepoints x parcels), same as np.nanmean of each parcel
+        """
+        if valid is None:
+            return np.asarray(self.weights.dot(data.T).T)
+        sums = np.asarray(self.indicator.dot(data.T).T)
+        n = np.asarray(self.indicator.dot(valid.T).T)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums / n
+
+
+def nan_split(data):
+    """ Prepares data for NaN-aware parcellation.
+
+    Return
+    ------
+    data : array, with NaNs replaced by zeros (a copy, only if there were NaNs)
+    valid : array float32 of finite values, None if data has no NaNs
+    """
+    nan_mask = np.isnan(data)
+    if not nan_mask.any():
+        return data, None
+    valid = (~nan_mask).astype(np.float32)
+    return np.where(nan_mask, 0, data).astype(data.dtype), valid
+
+
+def _sha1(fname):
+    with open(fname, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _cache_dirs(parcDir):
+    dirs = [os.path.join(parcDir, 'cache')]
+    if 'MICAPIPE_CACHE' in os.environ:
+        dirs.append(os.path.join(os.environ['MICAPIPE_CACHE'], 'parcellations'))
+    dirs.append(os.path.join(os.path.expanduser('~'), '.cache', 'micapipe', 'parcellations'))
+    return dirs
+
+
+def _save_cache(dirs, fname, **arrays):
+    # Atomic write: several subjects can build the same operator at once
+    for cacheDir in dirs:
+        try:
+            os.makedirs(cacheDir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(suffix='.npz', dir=cacheDir)
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp, os.path.join(cacheDir, fname))
+            return
+        except OSError:
+            continue
+    print('[WARNING]... parcellation cache is not writable, operator for ' + fname + ' was not cached')
+
+
+def load_operator(parcDir, parcellation):
+    """ Loads (or builds and caches) the averaging operator of a conte69 parcellation.
+
+    Parameters
+    ----------
+    parcDir : str, path to micapipe parcellations directory
+    parcellation : str, name of the parcellation (e.g. schaefer-400)
+
+    Return
+    ------
+    ParcelOperator
+    """
+    parcPath = os.path.join(parcDir, parcellation) + '_conte69.csv'
+    sha1 = _sha1(parcPath)
+    fname = parcellation + '_conte69.npz'
+    dirs = _cache_dirs(parcDir)
+    for cacheDir in dirs:
+        cached = os.path.join(cacheDir, fname)
+        if not os.path.isfile(cached):
+            continue
+        try:
+            with np.load(cached) as npz:
+                if str(npz['sha1']) == sha1:
+                    return ParcelOperator(npz['labels'], npz['uparcel'])
+        except (OSError, ValueError, KeyError):
+            pass
+    thisparc = np.loadtxt(parcPath)
+    uparcel, labels = np.unique(thisparc, return_inverse=True)
+    _save_cache(dirs, fname, labels=labels.astype(np.int32), uparcel=uparcel, sha1=sha1)
+    return ParcelOperator(labels, uparcel)
+
+
+def build_cache(parcDir):
+    """ Builds the cached operator of every conte69 parcellation in parcDir """
+    for parcPath in sorted(glob.glob(os.path.join(parcDir, '*_conte69.csv'))):
+        parcellation = os.path.basename(parcPath).replace('_conte69.csv', '')
+        op = load_operator(parcDir, parcellation)
+        print('[INFO]... {}: {} parcels'.format(parcellation, len(op.uparcel)))
+
+
+if __name__ == '__main__':
+    build_cache(sys.argv[1])
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Pooled functional connectomes of several runs (func_lab) of a subject.
+
+The pooled FC is the correlation of the concatenated, run-wise z-scored
+parcel timeseries. It only depends on the sufficient statistics of each run
+(number of timepoints, sums and cross-products of the z-scored timeseries),
+which are accumulated in a small state file per subject and parcellation:
+
+    <name>.state.npz : {runs, n_<i>, sum_<i>, cross_<i>, exclude_<i>}
+
+Adding (or re-processing) a run only updates its own statistics and excluded
+nodes, the pooled FC is finalized from the state without reloading any
+timeseries. The nodes excluded by any of the stored runs are set to zero.
+"""
+
+import os
+import fcntl
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+from dynamic_connectome import corr_from_sums
+
+
+def run_statistics(ts):
+    """ Sufficient statistics (n, sum, cross-products) of the z-scored timeseries (timepoints x N).
+
+    Columns without variance (e.g. empty parcels) are set to zero.
+    """
+    X = np.asarray(ts, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Z = (X - X.mean(axis=0)) / X.std(axis=0)
+    Z[:, ~np.isfinite(Z).all(axis=0)] = 0
+    return Z.shape[0], Z.sum(axis=0), Z.T @ Z
+
+
+@contextmanager
+def _locked(fileName):
+    """ Exclusive lock of the state file: runs of a subject may be processed by different workers """
+    with open(fileName + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class PooledFC:
+    """ Per-run sufficient statistics of a pooled FC, stored in <name>.state.npz
+
+    Parameters
+    ----------
+    fileName : str, <name>.state.npz
+
+    Attributes
+    ----------
+    runs : dict {run: (n, sum, cross-products)}
+    exclude : dict {run: set of nodes excluded in the run}
+    """
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.runs = {}
+        self.exclude = {}
+        if os.path.isfile(fileName):
+            with np.load(fileName) as npz:
+                # State files of the previous layout have one exclude set for all the runs
+                shared = set(npz['exclude'].tolist()) if 'exclude' in npz.files else set()
+                for i, run in enumerate(npz['runs']):
+                    run = str(run)
+                    self.runs[run] = (int(npz['n_{}'.format(i)]), npz['sum_{}'.format(i)], npz['cross_{}'.format(i)])
+                    key = 'exclude_{}'.format(i)
+                    self.exclude[run] = set(npz[key].tolist()) if key in npz.files else set(shared)
+
+    @property
+    def n_nodes(self):
+        return next(iter(self.runs.values()))[1].size if self.runs else None
+
+    def add(self, run, ts, exclude=()):
+        """ Adds (or replaces) the statistics of one run (timepoints x N) """
+        if self.n_nodes is not None and ts.shape[1] != self.n_nodes:
+            raise ValueError('Run {} has {} nodes, the pooled FC has {}'.format(run, ts.shape[1], self.n_nodes))
+        self.runs[run] = run_statistics(ts)
+        self.exclude[run] = set(int(i) for i in exclude)
+
+    def save(self):
+        """ Atomic write of the state file """
+        arrays = {'runs': np.array(sorted(self.runs))}
+        for i, run in enumerate(sorted(self.runs)):
+            n, S, C = self.runs[run]
+            arrays.update({'n_{}'.format(i): n, 'sum_{}'.format(i): S, 'cross_{}'.format(i): C,
+                           'exclude_{}'.format(i): np.array(sorted(self.exclude.get(run, ())), dtype=np.int64)})
+        fd, tmp = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(os.path.abspath(self.fileName)))
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, self.fileName)
+
+    def finalize(self):
+        """ Pooled FC, upper triangle (N x N) """
+        n = sum(stats[0] for stats in self.runs.values())
+        S = sum(stats[1] for stats in self.runs.values())
+        C = sum(stats[2] for stats in self.runs.values())
+        R = corr_from_sums(S, C, n)
+        # Union of the nodes excluded by the runs currently stored
+        exclude = sorted(set().union(*(self.exclude.get(run, set()) for run in self.runs)))
+        R[:, exclude] = 0
+        R[exclude, :] = 0
+        return np.triu(R)
+
+
+def update_pooled_fc(fileName, run, ts, exclude=(), writer=None):
+    """ Adds one run to the state file <name>.state.npz and returns the pooled FC and its runs.
+
+    writer(R, runs) saves the pooled FC while the state file is still locked, so
+    concurrent runs of a subject cannot overwrite it with an older pooled FC.
+    """
+    with _locked(fileName):
+        pooled = PooledFC(fileName)
+        pooled.add(run, ts, exclude)
+        pooled.save()
+        R, runs = pooled.finalize(), sorted(pooled.runs)
+        if writer is not None:
+            writer(R, runs)
+    return R, runs
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Intensity-profile cube: the sampled intensities of all the depths of one
+surface space (depth x vertex, both hemispheres) in a single file.
+
+The cube is a compressed npz with one chunk per depth ('depth-1', ...,
+'depth-N', in sampling order) plus the number of left hemisphere vertices
+('n_lh'). Each chunk is decompressed on its own, straight into its row of
+the output buffer.
+
+It replaces the per-depth, per-hemisphere and per-space *_label-MPC-<n>.func.gii
+files: 03_MPC.sh samples every hemisphere into one multi-map fsnative GIFTI
+(wb_command -metric-merge), resamples it once per surface space, and this
+script packs the scratch files into one cube per space in the MPC directory.
+Subjects processed with the per-depth layout are packed from their existing
+GIFTIs (-legacy), without sampling the surfaces again.
+
+    Functions
+    ---------
+    save_profile_cube : writes a (depth x vertex) cube
+    load_profile_cube : reads a cube as a (depth x vertex) array
+    load_profiles     : cube of a surface space, or the legacy per-depth GIFTIs
+    profile_files     : files read by load_profiles
+    legacy_files      : per-depth GIFTIs of the previous layout
+
+    Usage
+    -----
+    profile_cube.py <tmpDir> <outDir> <bids_id> <num_surf>
+    profile_cube.py -legacy <outDir> <bids_id> <num_surf>
+"""
+
+import os
+import sys
+import tempfile
+import numpy as np
+from gifti_io import load_func_gii, load_gii_stack
+
+# Surface spaces sampled by 03_MPC.sh
+SURFACES = ['fsnative', 'fsaverage5', 'fsLR-5k', 'fsLR-32k']
+
+
+def cube_name(OPATH, bids_id, surf):
+    return os.path.join(OPATH, "{bids_id}_surf-{surf}_desc-intensity_profiles.cube.npz".format(bids_id=bids_id, surf=surf))
+
+
+def save_profile_cube(data, fileName, n_lh):
+    """ Writes the (depth x vertex) intensities as a compressed, per-depth chunked cube.
+
+    Parameters
+    ----------
+    data : array (depth x vertex), depths in sampling order
+    fileName : str, path of the cube (.cube.npz)
+    n_lh : int, number of left hemisphere vertices
+    """
+    chunks = {'depth-{}'.format(n + 1): np.asarray(row, dtype=np.float32) for n, row in enumerate(data)}
+    # Atomic write: a killed job never leaves a truncated cube behind
+    fd, tmp = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(os.path.abspath(fileName)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, n_lh=np.int64(n_lh), **chunks)
+        os.replace(tmp, fileName)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def load_profile_cube(fileName, dtype=np.float32):
+    """ Reads a cube, one depth chunk at a time.
+
+    Return
+    ------
+    data : array (depth x vertex), depths in sampling order
+    n_lh : int, number of left hemisphere vertices
+    """
+    with np.load(fileName) as cube:
+        keys = sorted((k for k in cube.files if k.startswith('depth-')), key=lambda k: int(k.split('-')[1]))
+        data = None
+        for n, key in enumerate(keys):
+            row = cube[key]
+            if data is None:
+                data = np.empty((len(keys), row.size), dtype=dtype)
+            data[n] = row
+        return data, int(cube['n_lh'])
+
+
+def legacy_files(OPATH, bids_id, surf, num_surf=14):
+    """ Per-depth GIFTIs of the previous layout, left hemisphere depths then right hemisphere depths """
+    legacy = [os.path.join(OPATH, "{bids_id}_hemi-{{hemi}}_surf-{surf}_label-MPC-{n:d}.func.gii".format(bids_id=bids_id, surf=surf, n=n + 1))
+              for n in range(int(num_surf))]
+    return [f.format(hemi='L') for f in legacy] + [f.format(hemi='R') for f in legacy]
+
+
+def profile_files(OPATH, bids_id, surf, num_surf=14):
+    """ Files read by load_profiles: the cube, or the legacy per-depth GIFTIs of both hemispheres """
+    fileName = cube_name(OPATH, bids_id, surf)
+    if os.path.isfile(fileName):
+        return [fileName]
+    return legacy_files(OPATH, bids_id, surf, num_surf)
+
+
+def load_profiles(OPATH, bids_id, surf, num_surf=14, n_threads=None):
+    """ (depth x vertex) intensities of a surface space, in sampling order.
+
+    Reads the cube, or the per-depth GIFTIs of the previous layout if there is no cube.
+    """
+    files = profile_files(OPATH, bids_id, surf, num_surf)
+    if len(files) == 1:
+        return load_profile_cube(files[0])[0]
+    half = len(files) // 2
+    return load_gii_stack(files[:half], files[half:], n_threads=n_threads)
+
+
+if __name__ == '__main__':
+    legacy = sys.argv[1] == '-legacy'
+    if legacy:
+        outDir, bids_id, num_surf = sys.argv[2:5]
+    else:
+        tmpDir, outDir, bids_id, num_surf = sys.argv[1:5]
+    for surf in SURFACES:
+        if legacy:
+            # Per-depth GIFTIs of the previous layout, already in the MPC directory
+            files = legacy_files(outDir, bids_id, surf, num_surf)
+            half = len(files) // 2
+            data, widths = load_gii_stack(files[:half], files[half:], return_widths=True)
+        else:
+            # Multi-map GIFTI of each hemisphere: one darray per depth
+            hemis = ["{tmp}/{bids_id}_hemi-{hemi}_surf-{surf}_desc-MPC.func.gii".format(tmp=tmpDir, bids_id=bids_id, hemi=hemi, surf=surf)
+                     for hemi in ['L', 'R']]
+            data, widths = load_func_gii(hemis, return_widths=True)
+            if data.shape[0] != int(num_surf):
+                sys.exit('[ERROR].. {} has {} depths, expected {}'.format(hemis[0], data.shape[0], num_surf))
+        n_lh = widths[0]
+        fileName = cube_name(outDir, bids_id, surf)
+        save_profile_cube(data, fileName, n_lh)
+        print('[INFO]... saved {} ({:.1f} MB)'.format(fileName, os.path.getsize(fileName) / 1e6))
@@ -22,6 +22,11 @@
 # ses_num       session designation
 # num_surf		surface solution number (default is 14)
 # parc_name		name of parcellation in annotation file (default is vosdewael 200)
+#               or a comma separated list of annotation files: the intensity profiles are
+#               loaded once and the parcellations are processed in parallel threads (OMP_NUM_THREADS)
+# dir_fs        freesurfer subject directory
+# acq           acquisition (DEFAULT or acq-<name>)
+# n_gradients   optional, number of diffusion-map gradients of each MPC (default 0: none)
 
 # EXAMPLE INPUTS FOR MICS
 # dataDir = '/data_/mica3/BIDS_MIC/derivatives/'
@@ -36,7 +41,13 @@ import sys
 import os
 import numpy as np
 import nibabel as nb
+from concurrent.futures import ThreadPoolExecutor
 from build_mpc import build_mpc
+from diffusion_map import mpc_gradients, save_gradients
+from annot_parcellation import load_annot, mpc_exclude_labels
+from gifti_io import n_threads_default
+from profile_cube import load_profiles
+from packed_connectome import save_connectome
 
 # Define input arguments
 dataDir = sys.argv[1]
@@ -46,6 +57,7 @@ num_surf = sys.argv[4]
 parc_name = sys.argv[5]
 dir_fs = sys.argv[6]
 acq = sys.argv[7]
+n_gradients = int(sys.argv[8]) if len(sys.argv) > 8 else 0
 
 # Function save as gifti
 def save_gii(data_array, file_name):
@@ -79,67 +91,21 @@ if acq=="DEFAULT":
 else:
     OPATH = "{subject_dir}/mpc/{acq}/".format(subject_dir=ses_str, acq=acq)
 
-if os.path.exists(OPATH):
-    try:
+def load_parcellation(parc_name):
+    # Load parcellation in native surface space (decoded once per annotation, see annot_parcellation)
+    pathToParc = "{dir_fs}/label/".format(dir_fs=dir_fs)
+    parc, _, names_lh = load_annot(os.path.join(pathToParc, 'lh.' + parc_name), os.path.join(pathToParc, 'rh.' + parc_name))
+    uparcel = np.unique(parc)
 
-        # Get data for specified hemisphere and surface number
-        def get_hemisphere(surface_number, hemi):
-            thisname_gii = "{output}{bids_id}_hemi-{hemi}_surf-fsnative_label-MPC-{surface_number:d}.func.gii".format(output=OPATH, bids_id=bids_id, hemi=hemi, surface_number=surface_number+1)
-            data = nb.load(thisname_gii).darrays[0].data
-            return data
-
-        BBl = np.vstack(
-            [get_hemisphere(ii, 'L') for ii in range(int(num_surf))]
-        )
-        BBr = np.vstack(
-            [get_hemisphere(ii, 'R') for ii in range(int(num_surf))]
-        )
-
-        # Concatenate hemispheres and flip so pial surface is at the top
-        BB = np.flipud(np.concatenate((BBl, BBr), axis = 1))
-
-        # Load parcellation in native surface space
-        pathToParc = "{dir_fs}/label/".format(dir_fs=dir_fs)
-        # Load annot files
-        fname_lh = 'lh.' + parc_name
-        ipth_lh = os.path.join(pathToParc, fname_lh)
-        [labels_lh, ctab_lh, names_lh] = nb.freesurfer.io.read_annot(ipth_lh, orig_ids=True)
-        fname_rh = 'rh.' + parc_name
-        ipth_rh = os.path.join(pathToParc, fname_rh)
-        [labels_rh, ctab_rh, names_rh] = nb.freesurfer.io.read_annot(ipth_rh, orig_ids=True)
-        # Join hemispheres
-        parcLength = len(labels_lh)+len(labels_rh)
-        parc = np.zeros((parcLength))
-        for (x, _) in enumerate(labels_lh):
-            parc[x] = np.where(ctab_lh[:,4] == labels_lh[x])[0][0]
-        for (x, _) in enumerate(labels_rh):
-            parc[x + len(labels_lh)] = np.where(ctab_rh[:,4] == labels_rh[x])[0][0] + len(ctab_lh)
-        uparcel = np.unique(parc)
-
-        # Exclude medial wall and corpus callosum
-        # Some hardcoded things to deal with label naming specific to aparc and aparc-a2009s...
-        # Glasser, vosdewael, and Schaefer all have medial wall at same place
-        parcShortName = parc_name.replace("_mics.annot", "")
-        if parcShortName == 'aparc':
-            exclude_labels = []
-            for (i, _) in enumerate(names_lh):
-                # Exclude corpus callosum plus medial wall ("unknown")
-                if (names_lh[i].decode() == 'corpuscallosum' or names_lh[i].decode() == 'unknown'):
-                    reg = [i, i + int(len(uparcel)/2)]
-                    exclude_labels = np.append(exclude_labels, reg, axis = 0)
-        elif parcShortName == 'aparc-a2009s':
-            exclude_labels = []
-            for (i, _) in enumerate(names_lh):
-                # Exclude pericallosal plus medial wall.
-                # The label "unknown" is not represented in the parcellation.
-                # For this reason we have to adjust the label numbers by subtracting 1
-                if (names_lh[i].decode() == 'S_pericallosal' or names_lh[i].decode() == 'G_subcallosal' or names_lh[i].decode() == 'Medial_wall'):
-                    reg = [i-1, i + int(len(uparcel)/2)-1]
-                    exclude_labels = np.append(exclude_labels, reg, axis = 0)
-        else:
-            exclude_labels = np.asarray([0, int(len(uparcel)/2)])
-        # Convert type to int for indexing
-        exclude_labels = exclude_labels.astype(int)
+    # Exclude medial wall and corpus callosum
+    exclude_labels = mpc_exclude_labels(parc_name, names_lh, len(uparcel))
+    return parc, exclude_labels
+
+def parcellation_mpc(BB, parc_name):
+    # MPC and intensity profiles of one parcellation, BB is shared (read-only) between threads
+    # Returns 0 if successful, 1 if MPC building failed and -1 if something went wrong
+    try:
+        parc, exclude_labels = load_parcellation(parc_name)
 
         # Create MPC matrix (and nodal intensity profiles if parcellating)
         (MPC, I, problemNodes) = build_mpc(BB, parc, exclude_labels)
@@ -148,20 +114,40 @@ if os.path.exists(OPATH):
         if np.isnan(np.sum(MPC)):
             print("")
             print("-------------------------------------")
-            print("MPC building failed for subject {sub}".format(sub=sub))
+            print("MPC {parc} building failed for subject {sub}".format(sub=sub, parc=parc_name.replace('_mics.annot', '')))
             print("-------------------------------------")
             print("")
-            sys.exit(1)
+            return 1
         else:
             parc_str = parc_name.replace('_mics.annot', "")
-            save_gii(MPC, "{output}/{bids_id}_atlas-{parc_str}_desc-MPC.shape.gii".format(output=OPATH, bids_id=bids_id, parc_str=parc_str))
+            save_connectome(MPC, "{output}/{bids_id}_atlas-{parc_str}_desc-MPC.shape.gii".format(output=OPATH, bids_id=bids_id, parc_str=parc_str), meta={'atlas': parc_str})
             save_gii(I, "{output}/{bids_id}_atlas-{parc_str}_desc-intensity_profiles.shape.gii".format(output=OPATH, bids_id=bids_id, parc_str=parc_str))
+            if n_gradients > 0:
+                # Diffusion-map gradients of the MPC in memory, the excluded nodes are NaN
+                gradients, lambdas = mpc_gradients(MPC, n_components=n_gradients, exclude=exclude_labels)
+                save_gradients(gradients, lambdas, "{output}/{bids_id}_atlas-{parc_str}_desc-MPCgradients.shape.gii".format(output=OPATH, bids_id=bids_id, parc_str=parc_str), meta={'atlas': parc_str})
             print("")
             print("-------------------------------------")
             print("MPC {parc} building successful for subject {sub}".format(sub=sub, parc=parc_name.replace('_mics.annot', '')))
             print("-------------------------------------")
             print("")
-            sys.exit(0)
+            return 0
+    except Exception as e:
+        print("")
+        print("---------------------------------------------------------------------")
+        print("Something went wrong in loading or processing {parc} for subject {sub}".format(sub=sub, parc=parc_name))
+        print(e)
+        print("---------------------------------------------------------------------")
+        print("")
+        return -1
+
+if os.path.exists(OPATH):
+    parc_names = [name for name in parc_name.split(',') if name]
+    try:
+        # Load and concatenate hemispheres, flip so pial surface is at the top
+        # The intensity profiles are loaded once for all the parcellations
+        BB = np.flipud(load_profiles(OPATH, bids_id, 'fsnative', num_surf))
+        BB.setflags(write=False)
     except Exception as e:
         print("")
         print("---------------------------------------------------------------------")
@@ -170,3 +156,14 @@ if os.path.exists(OPATH):
         print("---------------------------------------------------------------------")
         print("")
         sys.exit(-1)
+
+    # Parcellations processed in parallel threads (numpy releases the GIL)
+    n_workers = min(len(parc_names), n_threads_default())
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        status = list(pool.map(lambda name: parcellation_mpc(BB, name), parc_names))
+    failed = [name for name, code in zip(parc_names, status) if code != 0]
+    if len(parc_names) > 1:
+        print("[INFO]... MPC built for {n}/{N} parcellations".format(n=len(parc_names) - len(failed), N=len(parc_names)))
+        if failed:
+            print("[ERROR].. MPC failed for: " + ", ".join(failed))
+    sys.exit(0 if not failed else (-1 if -1 in status else 1))
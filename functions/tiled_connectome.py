@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tiled, out-of-core vertex-wise connectomes.
+
+A dense fsLR-32k connectome (64k x 64k) does not fit in memory in float64.
+Here the timeseries are z-scored once and the correlation matrix is computed
+by blocks of rows with a single GEMM per tile (R = Z[:, rows]' Z[:, rows[0]:]).
+Only the upper triangle (diagonal included) is kept, and each tile is streamed
+into a memory-mapped vector, so peak memory is bounded by the memory ceiling
+regardless of the number of vertices.
+
+The output uses the packed upper triangle format of packed_connectome.py.
+"""
+
+from contextlib import contextmanager
+import numpy as np
+from packed_connectome import triu_size, triu_offset, create_packed
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+
+@contextmanager
+def blas_threads(n_threads=None):
+    """ Limits the BLAS threads (threadpoolctl, optional). None keeps OMP_NUM_THREADS """
+    if threadpool_limits is None or not n_threads:
+        yield
+    else:
+        with threadpool_limits(limits=n_threads, user_api='blas'):
+            yield
+
+
+def zscore(ts, dtype=np.float32):
+    """ Normalizes the columns of ts (timepoints x N) so that Z' Z is the correlation matrix.
+
+    Columns without variance (e.g. medial wall) are set to NaN, as np.corrcoef does.
+    """
+    Z = np.array(ts, dtype=dtype)
+    Z -= Z.mean(axis=0)
+    norm = np.sqrt(np.einsum('ij,ij->j', Z, Z, dtype=np.float64))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Z /= norm.astype(dtype)
+    return Z
+
+
+def tile_rows(N, mem_gb, itemsize=4):
+    """ Number of rows per tile so that the tile (rows x N) and its copy fit in mem_gb """
+    return int(max(1, min(N, (mem_gb * 1024**3) // (2 * N * itemsize))))
+
+
+def fisher_tile(tile, i):
+    """ MPC transform of a tile starting at row/column i, in place:
+    0.5 * log((1 + R) / (1 - R)), NaN and inf set to zero and zero diagonal """
+    np.arctanh(tile, out=tile)
+    np.nan_to_num(tile, copy=False, nan=0, posinf=0, neginf=0)
+    tile[:, :tile.shape[0]][np.diag_indices(tile.shape[0])] = 0
+    return tile
+
+
+def tiled_corrcoef(ts, out, mem_gb=4, n_threads=None, verbose=True, transform=None):
+    """ Vertex-wise correlation matrix streamed, tile by tile, to a packed upper triangle.
+
+    Parameters
+    ----------
+    ts : array (timepoints x N), cleaned timeseries
+    out : array (N*(N+1)/2), float32 or float16, usually a numpy memmap
+    mem_gb : float, memory ceiling of each tile (GB)
+    n_threads : int, BLAS threads. Default leaves the BLAS configuration (OMP_NUM_THREADS)
+    transform : function(tile, i), applied in place to each (clipped) tile, e.g. fisher_tile
+
+    Return
+    ------
+    out : the packed upper triangle of np.corrcoef(ts.T)
+    """
+    N = ts.shape[1]
+    if out.shape != (triu_size(N),):
+        raise ValueError('out must be a vector of {} values'.format(triu_size(N)))
+    Z = zscore(ts)
+    rows = tile_rows(N, mem_gb)
+    if verbose:
+        print('[INFO]... Tiled correlation: {N} x {N}, {rows} rows per tile, {dtype}'.format(N=N, rows=rows, dtype=out.dtype))
+    with blas_threads(n_threads):
+        for i in range(0, N, rows):
+            j = min(i + rows, N)
+            tile = Z[:, i:j].T @ Z[:, i:]
+            np.clip(tile, -1, 1, out=tile)
+            if transform is not None:
+                transform(tile, i)
+            for r in range(i, j):
+                start = triu_offset(r, N)
+                out[start:start + N - r] = tile[r - i, r - i:]
+            del tile
+            if verbose:
+                print('[INFO]... rows {j}/{N}'.format(j=j, N=N))
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+def save_tiled_corrcoef(ts, fileName, dtype=np.float32, mem_gb=4, n_threads=None, meta=None, transform=None):
+    """ Computes the vertex-wise correlation of ts into a packed connectome (<name>.triu.npy/json) """
+    out = create_packed(fileName, ts.shape[1], dtype=dtype, meta=meta)
+    tiled_corrcoef(ts, out, mem_gb=mem_gb, n_threads=n_threads, transform=transform)
+    del out
@@ -0,0 +1,93 @@
+"""
+Equivalence of functions/build_mpc.py (closed-form residualization, in-place
+correlation) with the previous per-column scipy.stats.linregress residuals and
+np.corrcoef, with excluded (NaN) nodes.
+"""
+
+import os
+import sys
+import warnings
+import numpy as np
+import scipy.stats
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions'))
+from build_mpc import build_mpc, residualize  # noqa: E402
+
+
+def linregress_residuals(I, I_M):
+    """ Previous residuals: one scipy.stats.linregress per column """
+    I_resid = np.zeros(I.shape)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for c in range(I.shape[1]):
+            slope, intercept, _, _, _ = scipy.stats.linregress(I_M, I[:, c])
+            I_resid[:, c] = I[:, c] - (intercept + slope * I_M)
+    return I_resid
+
+
+def baseline_mpc(I, idxExclude=None):
+    """ Previous MPC of the intensity profiles I """
+    I = I.copy()
+    if idxExclude is not None:
+        I[:, idxExclude] = np.nan
+    I_resid = linregress_residuals(I, np.nanmean(I, axis=1))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        R = np.corrcoef(I_resid, rowvar=False)
+        MPC = 0.5 * np.log(np.divide(1 + R, 1 - R))
+    MPC[np.isnan(MPC)] = 0
+    MPC[np.isinf(MPC)] = 0
+    np.fill_diagonal(MPC, 0)
+    return np.triu(MPC)
+
+
+@pytest.fixture
+def intensities():
+    rng = np.random.default_rng(0)
+    # Profiles sharing a mean trend across the surfaces, plus node-wise noise
+    trend = np.linspace(300, 100, 14)[:, None]
+    return trend * rng.uniform(0.5, 1.5, size=(1, 60)) + rng.normal(0, 20, size=(14, 60))
+
+
+def test_residualize_same_as_linregress(intensities):
+    I_M = intensities.mean(axis=1)
+    np.testing.assert_allclose(residualize(intensities, I_M), linregress_residuals(intensities, I_M), atol=1e-9)
+
+
+def test_residualize_nan_columns(intensities):
+    I = intensities.copy()
+    I[:, [2, 40]] = np.nan
+    I_M = np.nanmean(I, axis=1)
+    with np.errstate(invalid='ignore'):
+        out = residualize(I, I_M)
+    np.testing.assert_allclose(out, linregress_residuals(I, I_M), atol=1e-9)
+    assert np.isnan(out[:, [2, 40]]).all()
+
+
+# R = 1 on the diagonal, set to zero after the log transform
+@pytest.mark.filterwarnings('ignore:divide by zero:RuntimeWarning')
+@pytest.mark.parametrize('idxExclude', [None, [0, 31]])
+def test_mpc_same_as_corrcoef(intensities, idxExclude):
+    MPC, I, problemNodes = build_mpc(intensities.copy(), idxExclude=idxExclude)
+    assert problemNodes == 0
+    np.testing.assert_allclose(MPC, baseline_mpc(intensities, idxExclude), atol=1e-9)
+    if idxExclude is not None:
+        assert not MPC[idxExclude].any() and not MPC[:, idxExclude].any()
+
+
+@pytest.mark.filterwarnings('ignore:divide by zero:RuntimeWarning')
+def test_parcel_mpc_same_as_corrcoef(intensities):
+    rng = np.random.default_rng(1)
+    parc = rng.choice([10, 20, 30, 40, 50, 60], size=intensities.shape[1])
+    MPC, I, _ = build_mpc(intensities.copy(), parc=parc, idxExclude=[2])
+    assert MPC.shape == (6, 6)
+    np.testing.assert_allclose(MPC, baseline_mpc(I, [2]), atol=1e-9)
+
+
+def test_nan_profiles(intensities):
+    data = intensities.copy()
+    data[:, 7] = np.nan
+    MPC, I, problemNodes = build_mpc(data)
+    assert problemNodes == [7]
+    assert np.isnan(MPC).all() and np.isnan(I).all()
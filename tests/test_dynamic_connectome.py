@@ -0,0 +1,57 @@
+"""
+Equivalence of the incremental functions/dynamic_connectome.py sliding_corrcoef
+with np.corrcoef recomputed on every window.
+"""
+
+import os
+import sys
+import warnings
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions'))
+from dynamic_connectome import sliding_corrcoef, save_dynamic_fc, n_windows  # noqa: E402
+
+
+def window_corrcoef(ts, window, step):
+    """ np.corrcoef of every window """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return [np.corrcoef(ts[s:s + window], rowvar=False) for s in range(0, ts.shape[0] - window + 1, step)]
+
+
+@pytest.fixture
+def ts():
+    rng = np.random.default_rng(0)
+    # Timeseries with an offset and a drift, plus an empty (constant) parcel
+    X = rng.normal(size=(230, 12)) + 50 + np.linspace(0, 5, 230)[:, None]
+    X[:, 7] = 0
+    return X
+
+
+@pytest.mark.parametrize('window, step, refresh', [(30, 1, 100), (30, 1, 7), (45, 4, 100), (20, 20, 100), (25, 40, 3)])
+def test_same_as_corrcoef(ts, window, step, refresh):
+    expected = window_corrcoef(ts, window, step)
+    windows = list(sliding_corrcoef(ts, window, step, refresh))
+    assert len(windows) == len(expected) == n_windows(ts.shape[0], window, step)
+    for k, (start, R) in enumerate(windows):
+        assert start == k * step
+        np.testing.assert_allclose(R, expected[k], atol=1e-10)
+
+
+def test_saved_stack(ts, tmp_path):
+    fileName = str(tmp_path / 'dfc.triu.npy')
+    save_dynamic_fc(ts, fileName, 30, step=5, exclude=[2])
+    stack = np.load(fileName)
+    iu = np.triu_indices(ts.shape[1])
+    expected = window_corrcoef(ts, 30, 5)
+    assert stack.shape == (len(expected), len(iu[0]))
+    for k, R in enumerate(expected):
+        R[:, 2] = 0
+        R[2, :] = 0
+        np.testing.assert_allclose(stack[k], R[iu].astype(np.float32), atol=1e-6)
+
+
+def test_invalid_window(ts):
+    with pytest.raises(ValueError):
+        next(sliding_corrcoef(ts, ts.shape[0] + 1))
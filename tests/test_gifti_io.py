@@ -0,0 +1,63 @@
+"""
+Tests of functions/gifti_io.py: external binary GIFTIs must be memory-mapped,
+for one file and for one file per hemisphere.
+"""
+
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions'))
+import gifti_io  # noqa: E402
+
+_DARRAY = ('<DataArray Intent="NIFTI_INTENT_NONE" DataType="NIFTI_TYPE_FLOAT32" ArrayIndexingOrder="RowMajorOrder" '
+           'Dimensionality="1" Dim0="{n}" Encoding="ExternalFileBinary" Endian="LittleEndian" '
+           'ExternalFileName="{ext}" ExternalFileOffset="{offset}"><Data></Data></DataArray>')
+
+
+def write_external_gii(path, data):
+    """ func.gii with one darray per row of data, stored contiguously in <path>.dat """
+    ext = os.path.basename(path) + '.dat'
+    data = np.ascontiguousarray(data, dtype='<f4')
+    data.tofile(os.path.join(os.path.dirname(path), ext))
+    darrays = ''.join(_DARRAY.format(n=data.shape[1], ext=ext, offset=t * data.shape[1] * 4) for t in range(data.shape[0]))
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<GIFTI Version="1.0" NumberOfDataArrays="{}">{}</GIFTI>\n'
+                .format(data.shape[0], darrays))
+
+
+@pytest.fixture
+def hemispheres(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    lh, rh = rng.normal(size=(6, 10)), rng.normal(size=(6, 7))
+    files = [str(tmp_path / 'lh.func.gii'), str(tmp_path / 'rh.func.gii')]
+    write_external_gii(files[0], lh)
+    write_external_gii(files[1], rh)
+
+    # The memmap path never decodes a darray
+    def no_decode(self, out):
+        raise AssertionError('darray decoded instead of memory-mapped')
+    monkeypatch.setattr(gifti_io._DataArray, 'decode', no_decode)
+    return files, lh.astype(np.float32), rh.astype(np.float32)
+
+
+def test_single_file_is_memmap(hemispheres):
+    files, lh, _ = hemispheres
+    data = gifti_io.load_func_gii(files[0])
+    assert isinstance(data, np.memmap)
+    np.testing.assert_array_equal(data, lh)
+
+
+def test_hemispheres_are_memmapped(hemispheres):
+    files, lh, rh = hemispheres
+    data = gifti_io.load_func_gii(files)
+    assert data.dtype == np.float32
+    np.testing.assert_array_equal(data, np.concatenate((lh, rh), axis=1))
+
+
+def test_hemispheres_cast_from_memmap(hemispheres):
+    files, lh, rh = hemispheres
+    data = gifti_io.load_func_gii(files, dtype=np.float64)
+    assert data.dtype == np.float64
+    np.testing.assert_array_equal(data, np.concatenate((lh, rh), axis=1))
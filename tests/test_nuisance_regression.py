@@ -0,0 +1,70 @@
+"""
+Equivalence of functions/nuisance_regression.py ConfoundProjector with the
+previous sklearn LinearRegression residuals, with spike regressors or censored
+frames, and with NaN columns in the data.
+"""
+
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions'))
+from nuisance_regression import ConfoundProjector  # noqa: E402
+
+LinearRegression = pytest.importorskip('sklearn.linear_model').LinearRegression
+
+
+def sklearn_residuals(mdl, Data):
+    """ Previous get_regressed_data: slopes fitted with an intercept, only the slope term removed """
+    slm = LinearRegression().fit(mdl, Data)
+    return Data - np.dot(mdl, slm.coef_.T)
+
+
+@pytest.fixture
+def design():
+    rng = np.random.default_rng(0)
+    T = 120
+    confounds = rng.normal(size=(T, 8))
+    spikes = np.array([5, 17, 60, 61, 100])
+    spike_cols = np.zeros((T, len(spikes)))
+    spike_cols[spikes, np.arange(len(spikes))] = 1
+    Data = rng.normal(size=(T, 40)) + confounds @ rng.normal(size=(8, 40))
+    return np.ones((T, 1)), confounds, spikes, spike_cols, Data
+
+
+def test_same_residuals_as_sklearn(design):
+    ones, confounds, _, spike_cols, Data = design
+    mdl = np.concatenate([ones, spike_cols, confounds], axis=1)
+    out = ConfoundProjector(mdl, dtype=np.float64).apply(Data.copy())
+    np.testing.assert_allclose(out, sklearn_residuals(mdl, Data), atol=1e-10)
+
+
+def test_censoring_matches_spike_model(design):
+    ones, confounds, spikes, spike_cols, Data = design
+    keep = np.setdiff1d(np.arange(Data.shape[0]), spikes)
+    spike_model = sklearn_residuals(np.concatenate([ones, spike_cols, confounds], axis=1), Data)
+    projector = ConfoundProjector(np.concatenate([ones, confounds], axis=1), dtype=np.float64, censored=spikes)
+    out = projector.apply(Data.copy())
+    assert out.shape == (len(keep), Data.shape[1])
+    np.testing.assert_allclose(out, spike_model[keep], atol=1e-10)
+
+
+def test_nan_columns_stay_in_their_column(design):
+    ones, confounds, spikes, _, Data = design
+    Data = Data.copy()
+    Data[:, [3, 11]] = np.nan
+    finite = np.setdiff1d(np.arange(Data.shape[1]), [3, 11])
+    keep = np.setdiff1d(np.arange(Data.shape[0]), spikes)
+    mdl = np.concatenate([ones, confounds], axis=1)
+    out = ConfoundProjector(mdl, dtype=np.float64, censored=spikes, chunk=7).apply(Data.copy())
+    assert np.isnan(out[:, [3, 11]]).all()
+    np.testing.assert_allclose(out[:, finite], sklearn_residuals(mdl[keep], Data[keep][:, finite]), atol=1e-10)
+
+
+def test_float32_projection(design):
+    ones, confounds, _, _, Data = design
+    mdl = np.concatenate([ones, confounds], axis=1)
+    out = ConfoundProjector(mdl).apply(Data.astype(np.float32))
+    assert out.dtype == np.float32
+    np.testing.assert_allclose(out, sklearn_residuals(mdl, Data), atol=1e-4)
@@ -0,0 +1,107 @@
+"""
+Equivalence of functions/parcel_kernel.py SegmentedParcellation with the
+previous per-parcel loop of build_mpc (boolean mask, median/MAD outliers and
+np.nanmean of each parcel), with zero, zero-mean and NaN parcels.
+"""
+
+import os
+import sys
+import warnings
+import numpy as np
+import scipy.special
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions'))
+from parcel_kernel import SegmentedParcellation  # noqa: E402
+
+
+def loop_profiles(data, parc):
+    """ Previous intensity profiles of build_mpc, one parcel at a time """
+    uparcel = np.unique(parc)
+    I = np.zeros([data.shape[0], len(uparcel)])
+    c = -1 / (np.sqrt(2) * scipy.special.erfcinv(3/2))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for ii, thisparcel in enumerate(uparcel):
+            tmpData = data[:, parc == thisparcel]
+            tmpData[:, np.mean(tmpData) == 0] = 0
+            v = np.mean(tmpData, axis=0)
+            scaled_MAD = c * np.median(np.abs(v - np.median(v)))
+            idx = [i for i, x in enumerate(np.greater(v, (3 * scaled_MAD) + np.median(v))) if x]
+            if len(idx) > 0:
+                tmpData[:, idx] = np.nan
+            I[:, ii] = np.nanmean(tmpData, axis=1)
+    return I
+
+
+@pytest.fixture(params=[np.float32, np.float64])
+def profiles(request):
+    rng = np.random.default_rng(0)
+    parc = rng.choice([3, 5, 8, 13, 21, 34, 55], size=400)
+    data = rng.gamma(2, 100, size=(14, 400)).astype(request.param)
+    # Outlier vertices, a zero parcel, a zero-mean parcel, a NaN vertex and a NaN parcel
+    data[:, rng.choice(400, 12, replace=False)] *= 25
+    data[:, parc == 8] = 0
+    zero_mean = np.flatnonzero(parc == 13)
+    h = len(zero_mean) // 2
+    data[:, zero_mean[h:2 * h]] = -data[:, zero_mean[:h]]
+    data[:, zero_mean[2 * h:]] = 0
+    data[:, np.flatnonzero(parc == 21)[0]] = np.nan
+    data[:, parc == 55] = np.nan
+    return data, parc
+
+
+def test_profiles_same_as_loop(profiles):
+    data, parc = profiles
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        I = SegmentedParcellation(parc).mpc_profiles(data, robust='sort')
+    expected = loop_profiles(data, parc)
+    # The NaN vertex has no outlier threshold and is left out of the NaN-mean
+    assert np.isfinite(I[:, :6]).all() and np.isnan(I[:, 6]).all()
+    np.testing.assert_array_equal(I, expected)
+
+
+def test_profiles_keep_data(profiles):
+    data, parc = profiles
+    before = data.copy()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        SegmentedParcellation(parc).mpc_profiles(data, robust='sort')
+    np.testing.assert_array_equal(data, before)
+
+
+def test_mean_and_median(profiles):
+    data, parc = profiles
+    segments = SegmentedParcellation(parc)
+    values = segments.sort(data[0])
+    expected_mean = [np.mean(data[:, parc == label]) for label in segments.uparcel]
+    np.testing.assert_allclose(segments.mean(data).mean(axis=0), expected_mean, rtol=1e-5, atol=1e-3)
+    np.testing.assert_array_equal(segments.median(values), [np.median(data[0, parc == label]) for label in segments.uparcel])
+
+
+@pytest.mark.parametrize('max_scratch', [1, 64, 2**22])
+def test_robust_stats_same_as_median_mad(profiles, max_scratch):
+    data, parc = profiles
+    segments = SegmentedParcellation(parc)
+    values = segments.sort(np.mean(data, axis=0))
+    med, mad = segments.robust_stats(values, max_scratch=max_scratch)
+    expected_med, expected_mad = [], []
+    for label in segments.uparcel:
+        v = values[segments.uparcel[segments.segment] == label]
+        expected_med.append(np.median(v))
+        expected_mad.append(np.median(np.abs(v - np.median(v))))
+    # NaN vertex and NaN parcel
+    assert np.isnan(med[[4, 6]]).all() and np.isnan(mad[[4, 6]]).all()
+    np.testing.assert_array_equal(med, np.array(expected_med, dtype=values.dtype))
+    np.testing.assert_array_equal(mad, np.array(expected_mad, dtype=values.dtype))
+
+
+def test_select_same_as_sort(profiles):
+    data, parc = profiles
+    segments = SegmentedParcellation(parc)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        np.testing.assert_array_equal(segments.mpc_profiles(data, robust='select'), loop_profiles(data, parc))
+    with pytest.raises(ValueError):
+        segments.mpc_profiles(data, robust='mean')
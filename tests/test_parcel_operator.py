@@ -0,0 +1,70 @@
+"""
+Equivalence of functions/parcel_operator.py with the previous per-label
+np.nanmean parcellation, with NaN columns (vertices) and a fully NaN parcel.
+"""
+
+import os
+import sys
+import warnings
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions'))
+from parcel_operator import ParcelOperator, nan_split, load_operator  # noqa: E402
+
+
+def nanmean_parcellation(data_corr, thisparc):
+    """ Previous parcellation: one boolean mask and np.nanmean per label """
+    uparcel = np.unique(thisparc)
+    ts = np.zeros([data_corr.shape[0], len(uparcel)])
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for lab in range(len(uparcel)):
+            ts[:, lab] = np.nanmean(data_corr[:, thisparc == uparcel[lab]], axis=1)
+    return ts
+
+
+@pytest.fixture
+def parcellated():
+    rng = np.random.default_rng(0)
+    thisparc = rng.choice([0, 1001, 1002, 1005, 2001, 2003, 2010], size=300).astype(float)
+    data = rng.normal(size=(50, 300)).astype(np.float32)
+    return thisparc, data
+
+
+def operator(thisparc):
+    uparcel, labels = np.unique(thisparc, return_inverse=True)
+    return ParcelOperator(labels, uparcel)
+
+
+def test_same_as_nanmean(parcellated):
+    thisparc, data = parcellated
+    data_nan, valid = nan_split(data)
+    assert valid is None and data_nan is data
+    np.testing.assert_allclose(operator(thisparc)(data_nan, valid), nanmean_parcellation(data, thisparc), rtol=1e-5, atol=1e-6)
+
+
+def test_nan_columns(parcellated):
+    thisparc, data = parcellated
+    data = data.copy()
+    # NaN vertices, NaN entries in some frames, and one parcel with only NaNs
+    data[:, [4, 17, 120]] = np.nan
+    data[[3, 9], 200:210] = np.nan
+    data[:, thisparc == 1005] = np.nan
+    data_nan, valid = nan_split(data)
+    assert not np.isnan(data_nan).any()
+    ts = operator(thisparc)(data_nan, valid)
+    expected = nanmean_parcellation(data, thisparc)
+    assert np.isnan(ts[:, np.unique(thisparc) == 1005]).all()
+    np.testing.assert_allclose(ts, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_cached_operator(parcellated, tmp_path, monkeypatch):
+    thisparc, data = parcellated
+    monkeypatch.setenv('HOME', str(tmp_path))
+    np.savetxt(tmp_path / 'test_conte69.csv', thisparc)
+    for _ in range(2):
+        # Built from the CSV, then loaded from the cache
+        op = load_operator(str(tmp_path), 'test')
+        np.testing.assert_allclose(op(data), nanmean_parcellation(data, thisparc), rtol=1e-5, atol=1e-6)
+    assert os.path.isfile(tmp_path / 'cache' / 'test_conte69.npz')